@@ -0,0 +1,296 @@
+# Performance benchmarks of the editor and the serial pipeline.
+#
+# Every serial benchmark talks to a DeviceSimulator on a pseudo terminal, so
+# no board is needed. The editor benchmarks need a display, on a headless
+# machine run them under Xvfb. The results are printed as JSON:
+#
+#     xvfb-run python benchmark.py --output results.json
+#     python benchmark.py --only upload serial
+import argparse
+import json
+import logging
+import platform
+import queue
+import statistics
+import sys
+from time import perf_counter, sleep, strftime, time
+
+import tkinter as tk
+from tkinter import ttk
+
+import editor
+from simulator import DeviceSimulator
+
+FILE_SIZES = (100, 1000, 10000)  # lines of the files opened in a NotebookTab
+KEYSTROKES = 20  # edits measured per file size
+SCROLL_PAGES = 50  # gutter redraws measured per file size
+SERIAL_LINES = 2000  # lines printed by the device in the receive benchmark
+SCRIPT_SIZES = (1024, 4096, 16384, 65536)  # bytes of the scripts sent by uSerial.run
+TIMEOUT = 60  # seconds before a benchmark gives up waiting
+
+SAMPLE_SOURCE = '''\
+class Pixel{n}:
+    """A pixel of the strip number {n}"""
+    def __init__(self, red=0, green=0, blue=0):
+        self.color = (red, green, blue)  # stored as a tuple
+
+    def fade(self, step):
+        for i in range(step):
+            self.color = tuple(max(0, c - 1) for c in self.color)
+        return "faded {{}} times".format(step)
+
+'''
+
+
+def summary(samples):
+    # milliseconds
+    samples = sorted(samples)
+    return {
+        "samples": len(samples),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * .95))] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def sample_file(lines):
+    source = "".join(SAMPLE_SOURCE.format(n=n) for n in range(lines // 10 + 1))
+    return "\n".join(source.split("\n")[:lines])
+
+
+def device_script(size):
+    # a script of about size bytes which takes no time to run on the device
+    lines = ["# benchmark script", "values = {}"]
+    n = 0
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append("values['key_{0}'] = {0} * 2  # entry {0}".format(n))
+        n += 1
+    lines.append("print(len(values))")
+    return "\n".join(lines).encode()
+
+
+def pump(root, condition, timeout=TIMEOUT):
+    # Runs the Tk event loop until condition() is true
+    end = time() + timeout
+    while not condition():
+        if time() > end:
+            raise TimeoutError("benchmark timed out")
+        root.update()
+        sleep(.001)
+
+
+def open_tab(root, notebook, highlight_thread, lines):
+    tab = editor.NotebookTab(notebook, "benchmark.py", None, highlight_thread)
+    notebook.add(tab, text=tab.title)
+    notebook.select(tab)
+    tab.materialize()
+    tab.text_area.insert("1.0", sample_file(lines))
+    tab.python_lexer()
+    pump(root, lambda: tab.highlight_poll is None)
+    root.update_idletasks()
+    return tab
+
+
+def benchmark_highlight(root):
+    # Keystroke to highlight: a character is typed in the middle of the
+    # viewport and the time until every dirty line is coloured again is taken.
+    # The debounce delay is left out, it is waiting, not work.
+    notebook = ttk.Notebook(root)
+    notebook.pack(fill="both", expand=True)
+    highlight_thread = editor.HighlightThread()
+    results = []
+    for lines in FILE_SIZES:
+        start = perf_counter()
+        tab = open_tab(root, notebook, highlight_thread, lines)
+        first_highlight = perf_counter() - start
+        tab.text_area.see("%d.0" % (lines // 2))
+        root.update()
+
+        samples = []
+        for n in range(KEYSTROKES):
+            first, last = tab.visible_lines()
+            index = "%d.4" % ((first + last) // 2 + 1)
+            text = '"' if n % 2 == 0 else "x"  # quotes change the state of the following lines
+            start = perf_counter()
+            tab._key_event(None)
+            tab.text_area.insert(index, text)
+            tab.python_lexer()
+            pump(root, lambda: tab.highlight_poll is None)
+            samples.append(perf_counter() - start)
+        results.append(dict(lines=lines, first_highlight_ms=round(first_highlight * 1000, 3),
+                            keystroke=summary(samples)))
+        notebook.forget(tab)
+        tab.destroy()
+    notebook.destroy()
+    return results
+
+
+def benchmark_gutter(root):
+    # Cost of one gutter redraw while the text area is scrolled page by page
+    notebook = ttk.Notebook(root)
+    notebook.pack(fill="both", expand=True)
+    highlight_thread = editor.HighlightThread()
+    results = []
+    for lines in FILE_SIZES:
+        tab = open_tab(root, notebook, highlight_thread, lines)
+        samples = []
+        for n in range(SCROLL_PAGES):
+            tab.text_area.yview_scroll(1 if n < SCROLL_PAGES // 2 else -1, "pages")
+            tab.text_area.update_idletasks()  # layout the new view, only the redraw is measured
+            if tab.line_numbers_after:
+                tab.after_cancel(tab.line_numbers_after)
+            start = perf_counter()
+            tab.update_line_numbers()
+            samples.append(perf_counter() - start)
+        results.append(dict(lines=lines, redraw=summary(samples)))
+        notebook.forget(tab)
+        tab.destroy()
+    notebook.destroy()
+    return results
+
+
+class TimedQueue(queue.Queue):
+    # Remembers when each chunk was put, so the REPL render lag can be measured
+    def __init__(self):
+        super().__init__()
+        self.lags = []
+
+    def _put(self, item):
+        super()._put((perf_counter(), item))
+
+    def _get(self):
+        put_time, item = super()._get()
+        self.lags.append(perf_counter() - put_time)
+        return item
+
+
+def benchmark_serial(root, baudrate):
+    # Sustained receive throughput of the SerialThread while the device
+    # prints continuously, and how long the output waits to be shown
+    results = {}
+    with DeviceSimulator(baudrate=baudrate) as simulator:
+        u_serial = editor.uSerial(simulator.port)
+        frame = tk.Frame(root)
+        frame.pack()
+        repl = editor.Repl(frame, u_serial)
+        received_so_far, repl.receive_queue = repl.receive_queue, TimedQueue()
+        while not received_so_far.empty():
+            repl.receive_queue.put(received_so_far.get())
+        repl.serial_thread.start_time = time()
+        text = repl.repl_text_field
+        pump(root, lambda: text.get("end-5c", "end-1c") == ">>> ")
+
+        render_time = []
+        render_output = repl._render_output
+
+        def timed_render_output():
+            start = perf_counter()
+            render_output()
+            render_time.append(perf_counter() - start)
+        repl._render_output = timed_render_output
+
+        start = perf_counter()
+        bytes_before = repl.serial_thread.bytes_received
+        repl.send_queue.put("for i in range({}): print('%070d' % i)\r".format(SERIAL_LINES).encode())
+        repl.send_queue.put(b"print('benchmark' + 'done')\r")
+        pump(root, lambda: "benchmarkdone" in text.get("end-30c", "end"))
+        elapsed = perf_counter() - start
+        received = repl.serial_thread.bytes_received - bytes_before
+
+        repl._render_output = render_output
+        if repl.render_after:
+            repl.after_cancel(repl.render_after)
+        repl.serial_thread.stop()
+        u_serial.close()
+        frame.destroy()
+
+        results = dict(
+            baudrate=baudrate,
+            bytes=received,
+            seconds=round(elapsed, 3),
+            bytes_per_second=round(received / elapsed),
+            link_utilisation=round(received * 10 / baudrate / elapsed, 3) if baudrate else None,
+            render_lag=summary(repl.receive_queue.lags),
+            render_frame=summary(render_time),
+        )
+    return results
+
+
+def benchmark_upload(baudrate):
+    # uSerial.run time against script size, with and without compression
+    results = []
+    with DeviceSimulator(baudrate=baudrate) as simulator:
+        u_serial = editor.uSerial(simulator.port)
+        for size in SCRIPT_SIZES:
+            script = device_script(size)
+            for compress in (False, True):
+                u_serial.compress = compress
+                start = perf_counter()
+                u_serial.run(script)
+                elapsed = perf_counter() - start
+                u_serial.read_until(b">>> ", TIMEOUT)
+                transfer = u_serial.last_transfer
+                results.append(dict(
+                    bytes=len(script),
+                    compress=compress,
+                    sent=transfer["sent"],
+                    seconds=round(elapsed, 3),
+                    bytes_per_second=round(len(script) / elapsed),
+                ))
+        u_serial.close()
+    return results
+
+
+def tk_root():
+    # None when there is no display, the editor benchmarks are skipped then
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        return None
+    root.geometry("1000x700")
+    return root
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmarks of MicroPython Editor")
+    parser.add_argument("--only", nargs="+", choices=("highlight", "gutter", "serial", "upload"),
+                        default=("highlight", "gutter", "serial", "upload"), help="benchmarks to run")
+    parser.add_argument("--baudrate", type=int, default=115200, help="link speed of the simulated device")
+    parser.add_argument("--output", help="file receiving the JSON results (default: stdout)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report = {
+        "timestamp": strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tk": tk.TkVersion,
+        "results": {},
+    }
+    results = report["results"]
+    root = tk_root() if {"highlight", "gutter", "serial"} & set(args.only) else None
+    for name in args.only:
+        print("Running {} benchmark".format(name), file=sys.stderr)
+        if name == "upload":
+            results[name] = benchmark_upload(args.baudrate)
+        elif root is None:
+            results[name] = {"skipped": "no display, run the benchmark under Xvfb"}
+        elif name == "highlight":
+            results[name] = benchmark_highlight(root)
+        elif name == "gutter":
+            results[name] = benchmark_gutter(root)
+        elif name == "serial":
+            results[name] = benchmark_serial(root, args.baudrate)
+    if root:
+        root.destroy()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    run()
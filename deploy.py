@@ -0,0 +1,186 @@
+# Runs scripts on boards, copies folders to them and fetches files from them
+# without the editor window, e.g. on a build server flashing a batch of
+# boards. Every board is handled by a worker of its own, so a batch takes
+# about as long as its slowest board:
+#
+#     python deploy.py run main.py --port /dev/ttyUSB0 --port /dev/ttyUSB1
+#     python deploy.py sync firmware/ --remote-dir lib
+#     python deploy.py sync main.py
+#     python deploy.py fetch log.txt data.csv --dest logs/
+#
+# Without --port every USB serial device is used. The exit status is 0 when
+# all boards succeeded and 1 when any of them failed.
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+from time import perf_counter
+
+import serial # requires installing
+
+import device
+
+RUN_TIMEOUT = 30  # s a script may run before it counts as failed, unless started with --detach
+WORKERS = 8  # boards handled at the same time
+
+
+def script_modules(script, minify):
+    # {name: source} of the modules next to script which it imports, like
+    # the Run button of the editor sends them to the ModuleCache
+    path = os.path.abspath(script)
+    with open(path) as f:
+        source = f.read()
+    modules = {}
+    for name, module_path in device.import_graph.modules(source, os.path.dirname(path)):
+        if module_path == path:
+            continue  # the script itself is sent by run
+        with open(module_path) as f:
+            module = f.read()
+        modules[name] = (device.minify(module) if minify else module).encode()
+    return modules
+
+
+def run_script(u_serial, args, progress):
+    with open(args.script, "rb") as f:
+        source = f.read()
+    if args.minify:
+        source = device.minify(source.decode()).encode()
+    if args.detach:
+        # like the Run button, the script keeps running
+        u_serial.run(source, warm=args.warm, reload=args.reload, modules=args.modules)
+        return "started"
+    # the soft reset in the raw REPL does not run main.py, the script
+    # starts from a clean interpreter like with the Run button
+    with u_serial.raw_repl(soft_reset=not args.warm):
+        u_serial.prepare(args.warm, args.reload, args.modules)
+        return u_serial.exec_raw(u_serial.payload(source), timeout=args.timeout).decode(errors="replace")
+
+
+def sync_files(u_serial, args, progress):
+    # A script is sent with the local modules it imports, a folder completely
+    sync = device.FileSync(u_serial, progress)
+    with u_serial.raw_repl():
+        if os.path.isfile(args.path):
+            written = sync.sync_script(args.path, args.remote_dir)
+        else:
+            written = sync.sync_directory(args.path, args.remote_dir)
+    return "{} file(s) sent".format(len(written))
+
+
+def fetch_files(u_serial, args, progress):
+    # With several boards every one gets a folder named after its port
+    dest = args.dest
+    if len(args.ports) > 1:
+        dest = os.path.join(dest, os.path.basename(u_serial.port))
+    sync = device.FileSync(u_serial, progress)
+    with u_serial.raw_repl():
+        for remote_path in args.files:
+            local_path = os.path.join(dest, remote_path.lstrip("/"))
+            os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+            with open(local_path, "wb") as f:
+                f.write(sync.download(remote_path))
+            progress("{} fetched".format(remote_path))
+    return "{} file(s) fetched to {}".format(len(args.files), dest)
+
+
+def deploy(port, job, args):
+    # Runs job on the board at port, the errors of the board are returned, not raised
+    result = {"port": port, "ok": False, "seconds": 0, "output": ""}
+    start = perf_counter()
+    try:
+        u_serial = device.uSerial(port, soft_reset=not args.warm)
+    except (serial.SerialException, OSError) as e:
+        result["output"] = "Not connected: {}".format(e)
+        return result
+    try:
+        result["output"] = job(u_serial, args, lambda message: logging.info("%s: %s", port, message))
+        result["ok"] = True
+    except device.uSerialError as e:
+        # the output of the code up to the error and the traceback printed by the device
+        result["output"] = e.output.decode(errors="replace") + str(e)
+    except Exception as e:
+        # a failing board must not stop the others
+        logging.debug("%s failed", port, exc_info=True)
+        result["output"] = "Failed: {}".format(e)
+    finally:
+        u_serial.close()
+        result["seconds"] = perf_counter() - start
+    return result
+
+
+def report(result):
+    print("{}: {} in {:.2f} s".format(result["port"], "ok" if result["ok"] else "FAILED", result["seconds"]))
+    for line in result["output"].rstrip().splitlines():
+        print("    " + line)
+    sys.stdout.flush()
+
+
+def run():
+    parser = argparse.ArgumentParser(description="MicroPython Editor without the window")
+    parser.add_argument("--port", "-p", dest="ports", action="append",
+                        help="serial port of a board, repeat it for several boards (default: all USB serial devices)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="boards handled at the same time")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--verbose", "-v", action="store_true", help="show the progress of every board")
+    parser.set_defaults(warm=False)
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="run a script and print its output")
+    run_parser.add_argument("script")
+    run_parser.add_argument("--timeout", type=float, default=RUN_TIMEOUT, help="seconds the script may run")
+    run_parser.add_argument("--detach", action="store_true", help="start the script without waiting for it")
+    run_parser.add_argument("--minify", action="store_true", help="strip comments and docstrings before sending")
+    run_parser.add_argument("--warm", action="store_true",
+                            help="keep the interpreter and its imported modules instead of a soft reset")
+    run_parser.add_argument("--reload", nargs="+", default=(), metavar="MODULE",
+                            help="modules a warm run imports again")
+    run_parser.set_defaults(job=run_script)
+
+    sync_parser = commands.add_parser("sync", help="copy the changed files of a folder, or a script and the "
+                                                   "local modules it imports, to the boards")
+    sync_parser.add_argument("path")
+    sync_parser.add_argument("--remote-dir", default="", help="folder on the board receiving the files")
+    sync_parser.set_defaults(job=sync_files)
+
+    fetch_parser = commands.add_parser("fetch", help="copy files from the boards")
+    fetch_parser.add_argument("files", nargs="+")
+    fetch_parser.add_argument("--dest", default=".", help="local folder receiving the files")
+    fetch_parser.set_defaults(job=fetch_files)
+
+    args = parser.parse_args()
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+    args.ports = args.ports or device.usb_serial_devices()
+    if not args.ports:
+        parser.error("no serial devices found, connect a board or use --port")
+    if args.command == "run":
+        try:
+            args.modules = script_modules(args.script, args.minify)  # once for all boards
+        except (OSError, ValueError) as e:
+            parser.error("cannot read {} or its modules: {}".format(args.script, e))
+
+    start = perf_counter()
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = [pool.submit(deploy, port, args.job, args) for port in args.ports]
+        for future in concurrent.futures.as_completed(futures):
+            results.append(future.result())
+            if not args.json:
+                report(results[-1])
+    seconds = perf_counter() - start
+    failed = sum(not result["ok"] for result in results)
+
+    if args.json:
+        results.sort(key=lambda result: args.ports.index(result["port"]))
+        print(json.dumps({"seconds": seconds, "failed": failed, "results": results}, indent=2))
+    else:
+        print("{} board(s) in {:.2f} s, slowest {:.2f} s, {} failed".format(
+            len(results), seconds, max(result["seconds"] for result in results), failed))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,811 @@
+# The connection to a MicroPython board and what is done with it: running
+# code in the raw REPL, copying files and finding the local modules a
+# script imports. Nothing here needs Tk, so deploy.py also works on
+# machines without a display.
+import ast
+import base64
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import threading
+import tokenize
+import zlib
+from time import sleep, time
+
+import serial # requires installing
+import serial.tools.list_ports
+
+from metrics import metrics
+
+WARM_RUN = False  # Run interrupts the program and reuses the interpreter instead of a soft reset, imported modules stay loaded
+COMPRESS_TRANSFERS = True  # send zlib compressed code and files when the device can inflate them
+COMPRESS_WBITS = 10  # 1 KB window, small enough for the heap of an ESP8266
+SYNC_CHUNK = 384  # bytes of file data per base64 encoded write on the device
+SYNC_CHUNKS_PER_EXEC = 8  # writes sent to the device in one raw REPL command
+MODULE_CACHE_DIR = "/.modcache"  # folder on the device keeping the modules imported by the run code
+
+
+def imported_modules(source):
+    # Top level names of the modules imported by source
+    names = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+            names.add(node.module.split(".")[0])
+    return names
+
+
+class ImportGraph:
+    # Finds the modules next to a script which it imports, directly or
+    # through each other. The imports of every file are cached with its
+    # mtime and size, so only the files changed since the last analysis are
+    # parsed again. Packages are not followed, only single file modules.
+    def __init__(self):
+        self.files = {}  # absolute path -> ((mtime, size), imported names)
+
+    def parse(self, source):
+        metrics.count("import_graph_parses")
+        try:
+            return imported_modules(source)
+        except (SyntaxError, ValueError):
+            return set()  # the device reports it when the code runs
+
+    def imports(self, path, source=None):
+        # source is the unsaved text of the file, it is not cached
+        if source is not None:
+            return self.parse(source)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.files.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(path) as f:
+            names = self.parse(f.read())
+        self.files[path] = (key, names)
+        return names
+
+    def modules(self, source, directory, sources=None):
+        # [(name, path)] of the modules in directory reachable from source,
+        # every module after the ones it imports. sources ({absolute path:
+        # source}) replace the files.
+        sources = sources or {}
+        order = []
+        seen = set()
+
+        def visit(names):
+            for name in sorted(names):
+                path = os.path.abspath(os.path.join(directory, name + ".py"))
+                if name in seen or not (path in sources or os.path.isfile(path)):
+                    continue  # already visited, built in or installed on the device
+                seen.add(name)
+                visit(self.imports(path, sources.get(path)))
+                order.append((name, path))
+
+        visit(self.parse(source))
+        return order
+
+
+import_graph = ImportGraph()
+
+
+def _docstrings(source):
+    # {(line, column): replacement} of the docstrings minify removes, the
+    # plain strings starting the body of the module, a class or a function.
+    # A class or function keeps a no-op as its body may be nothing else, the
+    # module keeps nothing so from __future__ imports stay the first statement.
+    docstrings = {}
+    for node in ast.walk(ast.parse(source)):
+        if not isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) or not node.body:
+            continue
+        first = node.body[0]
+        if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+            docstrings[(first.lineno, first.col_offset)] = "" if isinstance(node, ast.Module) else "0"
+    return docstrings
+
+
+def minify(source):
+    # Removes comments, docstrings and most whitespace from Python source.
+    # Every line stays on its line number, so tracebacks from the device
+    # still point to the right line in the editor. Source which cannot be
+    # tokenized is returned unchanged and the device reports the error.
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+        docstrings = _docstrings(source)
+    except (tokenize.TokenError, IndentationError, SyntaxError, ValueError):
+        return source
+    lines = source.splitlines(True)
+    fstring_start = getattr(tokenize, "FSTRING_START", None)
+    fstring_end = getattr(tokenize, "FSTRING_END", None)
+
+    out = []
+    depth = 0
+    row = 1  # line the output is at
+    line_start = True  # next token starts a logical line
+    last = ""  # last emitted token
+    last_string = False  # last emitted token is a string literal
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        kind, text = token.type, token.string
+        if kind == tokenize.ENDMARKER:
+            break
+        if kind == tokenize.INDENT:
+            depth += 1
+        elif kind == tokenize.DEDENT:
+            depth -= 1
+        elif kind in (tokenize.NEWLINE, tokenize.NL):
+            out.append("\n")
+            row = token.end[0] + 1 if text else token.end[0]
+            line_start = kind == tokenize.NEWLINE or line_start
+            last = ""
+        elif kind != tokenize.COMMENT:
+            if kind == fstring_start:
+                # emit f-strings verbatim, their parts are not valid source on their own
+                nesting = 0
+                while True:
+                    if tokens[i].type == fstring_start:
+                        nesting += 1
+                    elif tokens[i].type == fstring_end:
+                        nesting -= 1
+                        if not nesting:
+                            break
+                    i += 1
+                end = tokens[i].end
+                if token.start[0] == end[0]:
+                    text = lines[end[0] - 1][token.start[1]:end[1]]
+                else:
+                    text = "".join([lines[token.start[0] - 1][token.start[1]:]] + lines[token.start[0]:end[0] - 1]
+                                   + [lines[end[0] - 1][:end[1]]])
+                token = token._replace(end=end)
+            elif kind == tokenize.STRING and token.start in docstrings:
+                following = i + 1
+                while tokens[following].type == tokenize.COMMENT:
+                    following += 1
+                if tokens[following].type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                    text = docstrings[token.start]
+            if token.start[0] > row:
+                # a backslash continued line
+                out.append("\\\n" * (token.start[0] - row))
+            if line_start:
+                out.append(" " * depth)
+            elif (last[-1:].isalnum() or last[-1:] == "_") and (text[:1].isalnum() or text[:1] == "_"):
+                out.append(" ")
+            elif last[-1:].isdigit() and text[:1] == ".":
+                out.append(" ")
+            elif last_string and kind in (tokenize.STRING, fstring_start):
+                out.append(" ")  # 'a' 'b' joined would be 'a''b' or the start of a triple quote
+            out.append(text)
+            out.append("\n" * (token.end[0] - token.start[0] - text.count("\n")))
+            row = token.end[0]
+            line_start = False
+            last = text
+            last_string = kind in (tokenize.STRING, fstring_start) and text != ""
+        i += 1
+    return "".join(out)
+
+
+def usb_serial_devices():
+    ports = list(serial.tools.list_ports.comports()) # get all serial devices
+    return sorted(dev.device for dev in ports if "USB" in dev.hwid) # their names (COMx or dev/ttyUSBx)
+
+
+class uSerialError(Exception):
+    def __init__(self, message, output=b""):
+        super().__init__(message)
+        self.output = output  # what the code printed before the error
+
+
+class uSerial(serial.Serial):
+    def __init__(self, port, soft_reset=True):
+        super().__init__(port, baudrate=115200, timeout=.2)
+        self.lock = threading.RLock()  # held by whoever is talking to the device
+        self.use_raw_paste = True  # cleared when the device does not support raw-paste mode
+        self.warm_run = WARM_RUN
+        self.module_manifest = None  # {module: hash} of the ModuleCache on the device, None until it is read
+        self.compress = COMPRESS_TRANSFERS
+        self.inflate = None  # whether the device can decompress, None until it is asked
+        self.last_transfer = None
+        self.bytes_written = 0  # to this port, the transfer reports are based on it
+        self.unread = b""  # received after what read_until looked for, returned by the next reads
+        self.write(b'\r\x03\x03') # ctrl-C twice: interrupt any running program
+        if soft_reset:
+            self.write(b'\x04') # ctrl-D: soft reset
+        else:
+            self.write(b'\r')
+        # wait for the prompt, main.py may keep running and never show it
+        if not self.read_until(b'>>> ', timeout=1).endswith(b'>>> '):
+            logging.warning("No REPL prompt from %s", port)
+        self.flushInput() # flush the rest of the reply
+
+    # Every byte on the port is counted, whoever sends or reads it
+
+    def read(self, size=1):
+        data, self.unread = self.unread[:size], self.unread[size:]
+        if len(data) < size:
+            received = super().read(size - len(data))
+            metrics.count("bytes_in", len(received))
+            data += received
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.unread) + super().in_waiting
+
+    def reset_input_buffer(self):
+        self.unread = b""
+        super().reset_input_buffer()
+
+    def write(self, data):
+        written = super().write(data)
+        metrics.count("bytes_out", written or 0)
+        self.bytes_written += written or 0
+        return written
+
+    def run(self, command, warm=None, reload=(), modules=None):
+        # A warm run skips the soft reset, the modules named in reload are
+        # imported again by the new code. modules ({name: source}) go to the
+        # ModuleCache of the device, only the changed ones are sent. Returns
+        # the paths written on the device.
+        warm = self.warm_run if warm is None else warm
+        with self.lock:
+            self.enter_raw_repl(soft_reset=not warm)
+            paths = self.prepare(warm, reload, modules)
+            start, written = time(), self.bytes_written
+            self.exec(self.payload(command))
+            self.report_transfer("Run", len(command), self.bytes_written - written, time() - start)
+            self.exit_raw_repl()
+        return paths
+
+    def payload(self, command):
+        # The code sent to run command, a launcher inflating it when that is
+        # shorter. Must be called in the raw REPL.
+        compressed = self.compress_payload(command)
+        if compressed is not None:
+            launcher = DEVICE_RUN_INFLATE.format(data=base64.b64encode(compressed).decode()).encode()
+            if len(launcher) < len(command):
+                return launcher
+        return command
+
+    def prepare(self, warm, reload=(), modules=None):
+        # Gets the interpreter ready for the run code, must be called in the
+        # raw REPL. A warm run forgets the globals of the previous program and
+        # the modules in reload, its timers and interrupt handlers keep
+        # running, only a soft reset stops them. modules are updated in the
+        # ModuleCache, which is put on sys.path. Returns the paths written.
+        setup = ""
+        paths = []
+        if modules:
+            changed = ModuleCache(self).update(modules)
+            reload = set(reload) | set(changed)
+            paths = ModuleCache.paths(changed) if changed else []
+            setup = DEVICE_MODULE_PATH.format(path=MODULE_CACHE_DIR)
+        if warm:
+            setup = DEVICE_WARM_RESET.format(modules=sorted(reload)) + setup
+        if setup:
+            self.exec_raw(setup)  # on its own, so the line numbers of the run code stay right
+        return paths
+
+    def compress_payload(self, data):
+        # zlib compressed data, or None when compression is off, not
+        # supported by the firmware or does not make data smaller
+        if not self.compress or not self.can_inflate():
+            return None
+        compressor = zlib.compressobj(9, zlib.DEFLATED, COMPRESS_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        return compressed if len(compressed) < len(data) else None
+
+    def can_inflate(self):
+        # Asks the device (in the raw REPL) once per connection
+        if self.inflate is None:
+            self.inflate = self.exec_raw(DEVICE_CAN_INFLATE).strip() == b"yes"
+        return self.inflate
+
+    def report_transfer(self, name, size, sent, seconds):
+        self.last_transfer = {
+            "name": name,
+            "size": size,
+            "sent": sent,
+            "ratio": sent / size if size else 1,
+            "bytes_per_second": size / seconds if seconds else 0,
+        }
+        logging.info("%s: %d bytes sent for %d (ratio %.2f), %.0f bytes/s effective",
+                     name, sent, size, self.last_transfer["ratio"], self.last_transfer["bytes_per_second"])
+
+    @contextlib.contextmanager
+    def raw_repl(self, soft_reset=False):
+        # Keeps the device in the raw REPL for several exec_raw calls
+        with self.lock:
+            self.enter_raw_repl(soft_reset)
+            try:
+                yield self
+            finally:
+                self.exit_raw_repl()
+
+    def exec_raw(self, command, timeout=10):
+        # Runs command in the raw REPL and returns what it printed
+        if isinstance(command, str):
+            command = command.encode()
+        self.exec(command)
+        output = self.expect(b'\x04', "the command", timeout)[:-1]
+        error = self.expect(b'\x04', "the command")[:-1]
+        self.expect(b'>', "the command")
+        if error:
+            raise uSerialError(error.decode(errors="replace").strip(), output)
+        return output
+
+    def run_file(self, filename):
+        with open(filename, 'rb') as f:
+            pyfile = f.read()
+        self.run(pyfile)
+
+    def enter_raw_repl(self, soft_reset=True):
+        self.write(b'\r\x03\x03') # ctrl-C twice: interrupt any running program
+        self.write(b'\r\x01') # ctrl-A: enter raw REPL
+        self.expect(b'raw REPL; CTRL-B to exit\r\n>', "entering the raw REPL")
+        if not soft_reset:
+            return
+
+        self.write(b'\x04') # ctrl-D: soft reset
+        self.expect(b'soft reboot\r\n', "the soft reset")
+        # boot.py runs between the two replies and may take a while
+        self.expect(b'raw REPL; CTRL-B to exit\r\n>', "the soft reset", timeout=10)
+
+    def exit_raw_repl(self):
+        # The program may still be running, the device switches to the
+        # friendly REPL once it finishes, so there is no reply to wait for
+        self.write(b'\r\x02') # ctrl-B: enter friendly REPL
+
+    def read_until(self, ending, timeout=1):
+        # Reads everything waiting at once, what follows the ending is kept
+        # for the next read
+        data = b""
+        deadline = time() + timeout
+        while time() < deadline:
+            searched = max(0, len(data) - len(ending) + 1)
+            data += self.read(max(1, self.in_waiting))
+            end = data.find(ending, searched)
+            if end >= 0:
+                end += len(ending)
+                self.unread = data[end:] + self.unread
+                return data[:end]
+        return data
+
+    def expect(self, ending, action, timeout=1):
+        data = self.read_until(ending, timeout)
+        if not data.endswith(ending):
+            raise uSerialError("No reply from the device during {} within {} s (received {!r})".format(
+                action, timeout, data[-40:]))
+        return data
+
+    def exec(self, command):
+        command_bytes = command.rstrip() + b"\n\r"
+
+        if self.use_raw_paste:
+            self.write(b'\x05A\x01') # ctrl-E A ctrl-A: ask for raw-paste mode
+            reply = self.read(2)
+            if reply == b'R\x01':
+                self.raw_paste_write(command_bytes)
+                return
+            if reply != b'R\x00':
+                # Old firmware: ctrl-A made it print the raw REPL banner again,
+                # its first two bytes were just read as the reply
+                self.expect(b'w REPL; CTRL-B to exit\r\n>', "the raw-paste request")
+            self.use_raw_paste = False
+
+        # write command
+        for i in range(0, len(command_bytes), 256):
+            self.write(command_bytes[i:min(i + 256, len(command_bytes))])
+            sleep(0.01)
+        self.write(b'\x04')
+        self.expect(b'OK', "the upload") # the device accepted the code
+
+    def raw_paste_write(self, command_bytes):
+        # The device grants a window of bytes and sends ctrl-A each time
+        # another window fits into its buffer
+        window_size = int.from_bytes(self.read(2), "little")
+        if not window_size:
+            raise uSerialError("Raw-paste mode: no window size received")
+        window_remain = window_size
+        i = 0
+        while i < len(command_bytes):
+            deadline = time() + 2
+            while window_remain == 0 or self.inWaiting():
+                reply = self.read(1)
+                if reply == b'\x01':
+                    window_remain += window_size
+                elif reply == b'\x04': # the device wants to end the transfer
+                    self.write(b'\x04')
+                    return
+                elif reply:
+                    raise uSerialError("Raw-paste mode: unexpected reply {!r}".format(reply))
+                elif time() > deadline:
+                    raise uSerialError("Raw-paste mode: the device stopped accepting data")
+            chunk = command_bytes[i:i + window_remain]
+            self.write(chunk)
+            window_remain -= len(chunk)
+            i += len(chunk)
+        self.write(b'\x04') # end of data, the device acknowledges it with ctrl-D
+        self.expect(b'\x04', "the raw-paste upload")
+
+
+# Snippets executed on the device by FileSync, they work with both the
+# u-prefixed module names of older firmware and the current ones. They run
+# in the globals of the program, so their work is done in functions whose
+# names start with _ and are deleted afterwards, the run code sees none of
+# their modules and variables.
+DEVICE_IMPORTS = """\
+ try:
+  import uos as os, uhashlib as hashlib, ubinascii as binascii
+ except ImportError:
+  import os, hashlib, binascii
+"""
+
+DEVICE_HASH = "def _hashes(paths):\n" + DEVICE_IMPORTS + """\
+ for path in paths:
+  try:
+   f = open(path, 'rb')
+  except OSError:
+   print('-')
+   continue
+  h = hashlib.sha256()
+  while True:
+   data = f.read(512)
+   if not data:
+    break
+   h.update(data)
+  f.close()
+  print(binascii.hexlify(h.digest()).decode())
+try:
+ _hashes({paths!r})
+finally:
+ del _hashes
+"""
+
+DEVICE_MKDIRS = "def _mkdirs(paths):\n" + DEVICE_IMPORTS + """\
+ for path in paths:
+  try:
+   os.mkdir(path)
+  except OSError:
+   pass
+try:
+ _mkdirs({paths!r})
+finally:
+ del _mkdirs
+"""
+
+# Opens the file written by the _w(_d(base64 data)) commands of
+# FileSync.writes, they delete _f, _w and _d when they close it
+DEVICE_OPEN = "def _open(path):\n" + DEVICE_IMPORTS + """\
+ f = open(path, 'wb')
+ return f, f.write, binascii.a2b_base64
+try:
+ _f, _w, _d = _open({path!r})
+finally:
+ del _open
+"""
+
+DEVICE_LIST = "def _list(paths):\n" + DEVICE_IMPORTS + """\
+ for path in paths:
+  try:
+   names = os.listdir(path)
+  except OSError:
+   continue
+  for name in names:
+   stat = os.stat(path.rstrip('/') + '/' + name)
+   print(repr((path, name, stat[0] & 0x4000 != 0, stat[6])))
+try:
+ _list({paths!r})
+finally:
+ del _list
+"""
+
+# Forgets the names defined by the previous run and unloads the given
+# modules, the rest of the imported modules stay in memory
+DEVICE_WARM_RESET = """\
+for _name in list(globals()):
+ if _name[0] != '_':
+  del globals()[_name]
+import sys as _sys, gc as _gc
+for _name in {modules!r}:
+ if _name in _sys.modules:
+  del _sys.modules[_name]
+_gc.collect()
+del _name, _sys, _gc
+"""
+
+# Lets the run code import the modules of the ModuleCache, before the
+# copies elsewhere on the device
+DEVICE_MODULE_PATH = """\
+import sys as _sys
+if {path!r} not in _sys.path:
+ _sys.path.insert(0, {path!r})
+del _sys
+"""
+
+DEVICE_CAN_INFLATE = """\
+def _can_inflate():
+ try:
+  import deflate
+  return True
+ except ImportError:
+  pass
+ try:
+  import zlib
+ except ImportError:
+  try:
+   import uzlib as zlib
+  except ImportError:
+   return False
+ return hasattr(zlib, 'DecompIO')
+try:
+ print('yes' if _can_inflate() else 'no')
+finally:
+ del _can_inflate
+"""
+
+# Defines _inflate(stream), returning a stream of the decompressed data.
+# The snippets using it delete it.
+DEVICE_INFLATE = """\
+def _inflate(stream):
+ try:
+  import deflate
+  return deflate.DeflateIO(stream, deflate.ZLIB)
+ except ImportError:
+  pass
+ try:
+  import zlib
+ except ImportError:
+  import uzlib as zlib
+ return zlib.DecompIO(stream, {wbits})
+""".replace("{wbits}", str(COMPRESS_WBITS))
+
+# Runs compressed code. _source deletes itself and _inflate before the code
+# starts, which may run forever.
+DEVICE_RUN_INFLATE = DEVICE_INFLATE + """\
+def _source(data):
+ try:
+  import ubinascii as binascii, uio as io
+ except ImportError:
+  import binascii, io
+ source = _inflate(io.BytesIO(binascii.a2b_base64(data))).read()
+ del globals()['_inflate'], globals()['_source']
+ return source
+exec(_source({data!r}))
+"""
+
+DEVICE_INFLATE_FILE = DEVICE_INFLATE + "def _inflate_file(source, path):\n" + DEVICE_IMPORTS + """\
+ compressed = open(source, 'rb')
+ data = _inflate(compressed)
+ f = open(path, 'wb')
+ while True:
+  chunk = data.read(256)
+  if not chunk:
+   break
+  f.write(chunk)
+ f.close()
+ compressed.close()
+ os.remove(source)
+try:
+ _inflate_file({source!r}, {path!r})
+finally:
+ del _inflate, _inflate_file
+"""
+
+# Opens the file read by DEVICE_READ
+DEVICE_READ_OPEN = "def _open(path):\n" + DEVICE_IMPORTS + """\
+ return open(path, 'rb'), binascii.b2a_base64
+try:
+ _f, _b = _open({path!r})
+finally:
+ del _open
+"""
+
+# Prints the next chunks of the file opened by DEVICE_READ_OPEN, "." at its
+# end, where the file is closed and _f and _b are deleted
+DEVICE_READ = """\
+def _read(count):
+ for i in range(count):
+  data = _f.read({chunk})
+  if not data:
+   return True
+  print(_b(data).decode().strip())
+try:
+ if _read({count}):
+  _f.close()
+  print('.')
+  del _f, _b
+finally:
+ del _read
+"""
+
+
+class FileSync:
+    # Copies files between the host and the device. Data is base64 encoded
+    # so binary files survive the raw REPL, and files whose SHA-256 is the
+    # same on both sides are not sent again. All methods expect the device
+    # to be in the raw REPL (see uSerial.raw_repl).
+    def __init__(self, u_serial, progress=None):
+        self.u_serial = u_serial
+        self.progress = progress or (lambda message: None)
+
+    @staticmethod
+    def local_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def remote_hashes(self, paths):
+        # {path: sha256 hex digest or None if the file does not exist}, one round trip for all paths
+        if not paths:
+            return {}
+        output = self.u_serial.exec_raw(DEVICE_HASH.format(paths=list(paths))).decode().split()
+        return {path: None if digest == "-" else digest for path, digest in zip(paths, output)}
+
+    def list_dirs(self, paths):
+        # {path: [(name, is_dir, size)]} for all paths with a single round trip
+        listings = {path: [] for path in paths}
+        for line in self.u_serial.exec_raw(DEVICE_LIST.format(paths=list(paths))).decode().splitlines():
+            path, name, is_dir, size = ast.literal_eval(line)
+            listings[path].append((name, is_dir, size))
+        return listings
+
+    def make_dirs(self, paths):
+        if paths:
+            self.u_serial.exec_raw(DEVICE_MKDIRS.format(paths=list(paths)))
+
+    @staticmethod
+    def writes(payload):
+        # The raw REPL commands writing payload to the file opened by DEVICE_OPEN
+        commands = []
+        writes = []
+        for i in range(0, len(payload), SYNC_CHUNK):
+            writes.append("_w(_d({!r}))".format(base64.b64encode(payload[i:i + SYNC_CHUNK]).decode()))
+            if len(writes) == SYNC_CHUNKS_PER_EXEC:
+                commands.append("\n".join(writes))
+                writes = []
+        commands.append("\n".join(writes + ["_f.close()", "del _f, _w, _d"]))
+        return commands
+
+    def upload(self, data, remote_path):
+        # Compressed data is written to a temporary file and inflated on the
+        # device, when that costs fewer bytes including the inflating code
+        start, written = time(), self.u_serial.bytes_written
+        commands = self.writes(data)
+        target = remote_path
+        inflate = None
+        compressed = self.u_serial.compress_payload(data)
+        if compressed is not None:
+            compressed_commands = self.writes(compressed)
+            inflate = DEVICE_INFLATE_FILE.format(source=remote_path + ".z", path=remote_path)
+            if sum(map(len, compressed_commands)) + len(inflate) < sum(map(len, commands)):
+                commands, target = compressed_commands, remote_path + ".z"
+            else:
+                inflate = None
+
+        self.u_serial.exec_raw(DEVICE_OPEN.format(path=target))
+        for number, command in enumerate(commands, 1):
+            self.u_serial.exec_raw(command)
+            if number < len(commands):
+                self.progress("{}: {}/{} commands".format(remote_path, number, len(commands)))
+        if inflate:
+            self.u_serial.exec_raw(inflate)
+
+        sent = self.u_serial.bytes_written - written
+        self.u_serial.report_transfer(remote_path, len(data), sent, time() - start)
+        self.progress("{}: {} bytes sent for {} (ratio {:.2f}), {:.0f} bytes/s".format(
+            remote_path, sent, len(data), self.u_serial.last_transfer["ratio"],
+            self.u_serial.last_transfer["bytes_per_second"]))
+
+    def download(self, remote_path):
+        # A few chunks per command, so no command runs long on a big file
+        self.u_serial.exec_raw(DEVICE_READ_OPEN.format(path=remote_path))
+        read = DEVICE_READ.format(count=SYNC_CHUNKS_PER_EXEC, chunk=SYNC_CHUNK)
+        data = []
+        while True:
+            lines = self.u_serial.exec_raw(read).split()
+            if lines[-1:] == [b"."]:
+                data.extend(lines[:-1])
+                return b"".join(base64.b64decode(line) for line in data)
+            data.extend(lines)
+            self.progress("{}: {} bytes received".format(remote_path, len(data) * SYNC_CHUNK))
+
+    def upload_file(self, local_path, remote_path, force=False):
+        # Returns True if the file was sent, False if the device already has it
+        with open(local_path, "rb") as f:
+            data = f.read()
+        if not force and self.remote_hashes([remote_path])[remote_path] == self.local_hash(data):
+            return False
+        self.upload(data, remote_path)
+        return True
+
+    def sync_directory(self, local_dir, remote_dir=""):
+        # Sends every changed file below local_dir, returns the paths sent
+        files = {}
+        for root, dirs, names in os.walk(local_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+            for name in sorted(names):
+                if name.startswith("."):
+                    continue
+                relative = os.path.relpath(os.path.join(root, name), local_dir).replace(os.sep, "/")
+                files["/".join(filter(None, [remote_dir, relative]))] = os.path.join(root, name)
+        return self.sync_files(files)
+
+    def sync_script(self, local_path, remote_dir=""):
+        # Sends a script and the local modules it needs (see ImportGraph),
+        # every module before the ones importing it. Returns the paths sent.
+        with open(local_path) as f:
+            source = f.read()
+        files = {}
+        for name, path in import_graph.modules(source, os.path.dirname(os.path.abspath(local_path))):
+            files["/".join(filter(None, [remote_dir, name + ".py"]))] = path
+        files["/".join(filter(None, [remote_dir, os.path.basename(local_path)]))] = local_path
+        return self.sync_files(files)
+
+    def sync_files(self, files):
+        # Sends the changed files of {remote path: local path} in their order,
+        # returns the paths sent
+        contents = {}
+        for remote_path, local_path in files.items():
+            with open(local_path, "rb") as f:
+                contents[remote_path] = f.read()
+        remote = self.remote_hashes(list(files))
+        changed = [path for path in files if remote[path] != self.local_hash(contents[path])]
+        self.progress("{} of {} files changed".format(len(changed), len(files)))
+
+        dirs = set()
+        for path in changed:
+            parts = path.split("/")[:-1]
+            dirs.update("/".join(parts[:i]) for i in range(1, len(parts) + 1))
+        self.make_dirs(sorted(d for d in dirs if d))
+
+        for path in changed:
+            self.upload(contents[path], path)
+            self.progress("{} sent".format(path))
+        return changed
+
+
+class ModuleCache:
+    # Keeps the modules imported by the run code in MODULE_CACHE_DIR on the
+    # device, with a manifest of their hashes. A run only sends the modules
+    # whose hash changed. Expects the device to be in the raw REPL.
+    MANIFEST = MODULE_CACHE_DIR + "/manifest"
+
+    def __init__(self, u_serial, progress=None):
+        self.u_serial = u_serial
+        self.sync = FileSync(u_serial, progress)
+
+    @classmethod
+    def paths(cls, names):
+        # The paths written by an update sending the modules names, the
+        # folder included as the update may have created it
+        return [MODULE_CACHE_DIR, cls.MANIFEST] + ["{}/{}.py".format(MODULE_CACHE_DIR, name) for name in names]
+
+    def manifest(self):
+        # Read from the device once per connection, nothing else writes it
+        if self.u_serial.module_manifest is None:
+            try:
+                lines = self.sync.download(self.MANIFEST).decode().splitlines()
+            except uSerialError:
+                lines = []  # no cache on the device yet
+            self.u_serial.module_manifest = dict(line.split() for line in lines if len(line.split()) == 2)
+        return self.u_serial.module_manifest
+
+    def update(self, modules):
+        # Sends the changed modules ({name: source}), returns their names
+        manifest = self.manifest()
+        hashes = {name: FileSync.local_hash(source) for name, source in modules.items()}
+        changed = sorted(name for name in modules if manifest.get(name) != hashes[name])
+        logging.info("Module cache: %d of %d modules changed", len(changed), len(modules))
+        if not changed:
+            return changed
+
+        self.sync.make_dirs([MODULE_CACHE_DIR])
+        self.u_serial.module_manifest = None  # unknown if an upload fails
+        for name in changed:
+            self.sync.upload(modules[name], "{}/{}.py".format(MODULE_CACHE_DIR, name))
+        manifest.update((name, hashes[name]) for name in changed)
+        self.sync.upload("".join("{} {}\n".format(*item) for item in sorted(manifest.items())).encode(),
+                         self.MANIFEST)
+        self.u_serial.module_manifest = manifest
+        return changed
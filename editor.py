@@ -1,27 +1,30 @@
+from time import sleep, time, perf_counter
+
+# Taken before the other imports, so the "imports" phase of the startup
+# breakdown includes them
+STARTUP_TIME = perf_counter()
+
 import tkinter as tk
 from tkinter import ttk
 import serial # requires installing
-import serial.tools.list_ports
-from time import sleep, time
 import threading 
-from PIL import Image, ImageTk # requires installing
 import logging
+import logging.handlers
 import queue
 import os
 import subprocess
 from tkinter import filedialog
 import sys
+import codecs
+import io
+import locale
+import mmap
+import json
+import select
 
-from pygments import lex
-from pygments.lexers import PythonLexer
-
-
-# tkinter on scrollbar instead of loo 60ms!!!
-# every single fucking tab!!!!
-
-logging.basicConfig(level=logging.DEBUG,
-                    format='(%(threadName)-10s) %(message)s',
-                    )
+from device import FileSync, ModuleCache, import_graph, minify, uSerial, uSerialError, usb_serial_devices
+from metrics import metrics
+# Pillow and pygments take long to import, they are imported when first needed
 
 def center_window(window):
     window.update_idletasks()
@@ -32,12 +35,232 @@ def center_window(window):
     y = h/2 - size[1]/2
     window.geometry("%dx%d+%d+%d" % (size + (x, y)))
 
+
+HIGHLIGHT_DELAY = 30  # ms of keyboard inactivity before the buffer is re-highlighted
+HIGHLIGHT_CHUNK = 100  # lines lexed by the HighlightThread before they are sent to the UI
+HIGHLIGHT_SLICE = 200  # lines coloured outside of the viewport per idle slice
+LOAD_CHUNK = 64 * 1024  # bytes of a file inserted into its tab per idle slice
+LOAD_MMAP_SIZE = 4 * 1024 * 1024  # files from this size on are memory-mapped instead of read
+HIGHLIGHT_EXTENSIONS = (".py", ".pyw")  # other files are shown without syntax highlighting
+TAB_WIDGETS_KEPT = 8  # tabs keeping their widgets, the least recently selected others release them, None keeps all
+SESSION_FILE = os.path.join(os.path.expanduser("~"), ".micropython_editor_session.json")  # tabs open at exit
+REPL_REFRESH_RATE = 30  # how many times per second new serial output is shown in the REPL
+REPL_SCROLLBACK = 5000  # lines kept in the REPL, older ones are removed
+REPL_TRIM_BATCH = 500  # lines over the limit before the REPL is trimmed
+REPL_LOG_FILE = None  # path of the files receiving the whole REPL session, the port is added to the name of each, None to disable
+REPL_LOG_SIZE = 1024 * 1024  # bytes per session log file before it is rotated
+REPL_LOG_BACKUPS = 5  # rotated session log files kept on disk
+MINIFY_UPLOAD = True  # strip comments, docstrings and indentation from code sent by Run
+LOG_LEVEL = logging.WARNING  # logging.DEBUG shows every transfer and thread event on the console
+METRICS_REFRESH = 1000  # ms between updates of the metrics in the status bar
+METRICS_MESSAGE_TIME = 5  # s a message about the metrics file is shown before the live metrics return
+DEVICE_POLL_INTERVAL = 1  # s between checks for plugged in boards when udev events are not available
+DEVICE_EVENT_POLL = 250  # ms between checks of the Tk thread for plugged in and removed boards
+METRICS_FILE = os.path.join(os.path.expanduser("~"), "micropython_editor_metrics.json")  # written on click
+ICON_SIZE = 40  # px, toolbar icons are resized to it once and cached
+ICON_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                              "micropython_editor", "icons")
+
+logging.basicConfig(level=LOG_LEVEL,
+                    format='(%(threadName)-10s) %(message)s',
+                    )
+
+
+class IncrementalLexer:
+    # Lexes a buffer line by line and remembers the pygments state stack at the
+    # start of every line. After an edit only the lines from the first changed
+    # one are lexed again, until the state matches the remembered one again.
+    #
+    # The model (lines, states, clean) is only changed on the Tk thread, lex()
+    # runs in the HighlightThread and stops as soon as the generation changes.
+    def __init__(self):
+        self.lexer = None  # pygments' PythonLexer, created by the first lex() so startup does not import pygments
+        self.lines = []
+        self.states = [("root",)]  # states[i] is the stack at the start of line i
+        self.clean = []  # clean[i] is True when line i is coloured for its current text
+        self.generation = 0
+        self.tags = {}  # token type -> tag name cache
+
+    def tag_name(self, token):
+        if token not in self.tags:
+            self.tags[token] = ".".join(["Token"] + list(token[:1]))  # e.g. Token.Keyword
+        return self.tags[token]
+
+    def edit(self, new_lines):
+        # Marks the changed lines as dirty, returns False if nothing changed
+        old_lines = self.lines
+        if new_lines == old_lines:
+            return False
+        self.generation += 1  # cancels the running job
+
+        first = 0
+        common = min(len(old_lines), len(new_lines))
+        while first < common and old_lines[first] == new_lines[first]:
+            first += 1
+        suffix = 0
+        while suffix < common - first and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+            suffix += 1
+
+        if first == len(new_lines):  # lines were only removed from the end
+            self.states = self.states[:first + 1]
+            self.clean = self.clean[:first]
+        else:
+            # The unchanged tail keeps its old states, they are compared with
+            # the new ones to find out where the lexer re-synchronises
+            dirty_end = max(len(new_lines) - suffix, first + 1)
+            tail = dirty_end - (len(new_lines) - len(old_lines))
+            self.states = self.states[:first + 1] + [None] * (dirty_end - first - 1) + self.states[tail:]
+            self.clean = self.clean[:first] + [False] * (dirty_end - first) + self.clean[tail:]
+        self.lines = new_lines
+        return True
+
+    def job(self):
+        return (self.generation, self.lines, self.clean, self.states)
+
+    def _load_lexer(self):
+        from pygments.lexers.python import PythonLexer
+        from pygments.token import Error, Whitespace, _TokenType
+        self.token_type = _TokenType
+        self.whitespace_tag = self.tag_name(Whitespace)
+        self.error_tag = self.tag_name(Error)
+        self.lexer = PythonLexer()
+
+    def lex(self, generation, lines, clean, states):
+        # Yields (line, start state, tokens, end state) for every line that has
+        # to be coloured again. Tokens are (col, length, tag) tuples.
+        if self.lexer is None:
+            self._load_lexer()
+        try:
+            line = clean.index(False)
+        except ValueError:
+            return
+        stack = states[line]
+        while line < len(lines) and generation == self.generation:
+            tokens, end = self._lex_line(lines[line] + "\n", stack)
+            yield line, stack, tokens, end
+            line += 1
+            if line < len(lines) and clean[line] and states[line] == end:
+                # state re-synchronised, continue with the next dirty line
+                try:
+                    line = clean.index(False, line)
+                except ValueError:
+                    return
+                stack = states[line]
+            else:
+                stack = end
+
+    def commit(self, line, start, end):
+        # Neighbours that were coloured for different states become dirty
+        self.clean[line] = True
+        if self.states[line] != start:
+            self.states[line] = start
+            if line > 0:
+                self.clean[line - 1] = False
+        if self.states[line + 1] != end:
+            self.states[line + 1] = end
+            if line + 1 < len(self.clean):
+                self.clean[line + 1] = False
+
+    def _lex_line(self, text, stack):
+        # Same state machine as pygments' RegexLexer.get_tokens_unprocessed,
+        # but it also returns the state stack reached at the end of the line.
+        tokens = []
+        pos = 0
+        tokendefs = self.lexer._tokens
+        statestack = list(stack)
+        statetokens = tokendefs[statestack[-1]]
+        while pos < len(text):
+            for rexmatch, action, new_state in statetokens:
+                m = rexmatch(text, pos)
+                if m:
+                    if action is not None:
+                        if type(action) is self.token_type:
+                            tokens.append((pos, m.end() - pos, self.tag_name(action)))
+                        else:
+                            for index, token, value in action(self.lexer, m):
+                                if value:
+                                    tokens.append((index, len(value), self.tag_name(token)))
+                    pos = m.end()
+                    if new_state is not None:
+                        if isinstance(new_state, tuple):
+                            for state in new_state:
+                                if state == "#pop":
+                                    if len(statestack) > 1:
+                                        statestack.pop()
+                                elif state == "#push":
+                                    statestack.append(statestack[-1])
+                                else:
+                                    statestack.append(state)
+                        elif isinstance(new_state, int):
+                            if abs(new_state) >= len(statestack):
+                                del statestack[1:]
+                            else:
+                                del statestack[new_state:]
+                        elif new_state == "#push":
+                            statestack.append(statestack[-1])
+                        statetokens = tokendefs[statestack[-1]]
+                    break
+            else:
+                if text[pos] == "\n":
+                    # at EOL, reset state to "root"
+                    statestack = ["root"]
+                    statetokens = tokendefs["root"]
+                    tokens.append((pos, 1, self.whitespace_tag))
+                else:
+                    tokens.append((pos, 1, self.error_tag))
+                pos += 1
+        return tokens, tuple(statestack)
+
+
+class HighlightThread(threading.Thread):
+    # Lexes the tabs in the background, so that colouring never blocks the Tk main loop
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.name = "HighlightThread"
+        self.jobs = queue.Queue()
+        self.start()
+
+    def submit(self, lexer, results, flush_line):
+        self.jobs.put((lexer, lexer.job(), results, flush_line))
+
+    def run(self):
+        while True:
+            lexer, job, results, flush_line = self.jobs.get()
+            generation = job[0]
+            if generation != lexer.generation:
+                continue  # a newer job for the same buffer is already queued
+            chunk = []
+            start = perf_counter()
+            for item in lexer.lex(*job):
+                chunk.append(item)
+                # the viewport is sent as soon as it is lexed
+                if len(chunk) >= HIGHLIGHT_CHUNK or item[0] == flush_line:
+                    results.put((generation, chunk, False))
+                    chunk = []
+            results.put((generation, chunk, True))
+            metrics.record("lex_job", perf_counter() - start)
+
 class NotebookTab(ttk.Frame):
-    def __init__(self, master, title, file):
+    # A tab is an empty frame holding a path or plain text until it is
+    # selected for the first time, then materialize() creates its widgets.
+    # release() removes them again from tabs which were not used for long.
+    def __init__(self, master, title, file, highlight_thread, text=None):
         super().__init__(master)
         self.master = master   
         self.title = title
         self.file = file
+        self.highlight_thread = highlight_thread
+        self.text = text  # content while there are no widgets, None means the file
+        self.modified = False
+        self.materialized = False
+        self.highlight = file is None or file.lower().endswith(HIGHLIGHT_EXTENSIONS)
+        self.loading = False
+
+    def materialize(self):
+        if self.materialized:
+            return
+        self.materialized = True
 
         self.rowconfigure(0, weight=1) 
         self.columnconfigure(1, weight=1)
@@ -59,14 +282,34 @@ class NotebookTab(ttk.Frame):
             # bg="black",  # background color
             # fg="green",  # default text color
             wrap=tk.NONE,  # allows lines to be infinitely long
-            yscrollcommand=self.y_scrollbar.set,
+            yscrollcommand=self._yscroll_event,
             xscrollcommand=self.x_scrollbar.set,
             font="{fixedsys} 12",
             # insertbackground="white",  # cursor color
         )
 
-        self.last_line_number = None
-        self.update_line_numbers()
+        # The gutter is only redrawn when the view or the text changes and
+        # reuses its canvas items. yscrollcommand is not called when lines
+        # are added to a text shorter than the view, so every insert and
+        # delete, by the keyboard, the mouse or a drop, goes through
+        # _text_command, which stands in for the Tk command of the widget.
+        self.line_number_items = []  # canvas text items, one per visible line
+        self.line_number_shown = []  # (text, y) currently shown by each item, None if hidden
+        self.line_numbers_after = None
+        self.text_area.bind("<Configure>", self.schedule_line_numbers)
+        self.text_area.bind("<Map>", self.schedule_line_numbers)
+        self.text_widget_command = self.text_area._w + "_widget"
+        self.tk.call("rename", self.text_area._w, self.text_widget_command)
+        self.tk.createcommand(self.text_area._w, self._text_command)
+
+        self.lexer = IncrementalLexer()
+        self.highlight_tags = set()
+        self.highlight_results = queue.Queue()
+        self.highlight_pending = []  # lexed lines waiting to be coloured
+        self.highlight_done = True
+        self.highlight_after = None  # debounce timer
+        self.highlight_poll = None
+        self._set_text_tags()
 
         self.text_area.bind("<Tab>", self._tab_event)
         # self.text_area.bind("<Shift-ISO_Left_Tab>", self._shift_tab_event)
@@ -74,13 +317,93 @@ class NotebookTab(ttk.Frame):
         self.text_area.bind("<Control-A>", self._control_a_event)
         self.text_area.bind("<Key>", self._key_event)
         self.text_area.bind("<KeyRelease>", self._release_key)
+        self.text_area.bind("<<Modified>>", self._modified_event)
 
-        if file:
-            with open(file, "r") as f:
-                file_content = f.read()
-                file_content = file_content.replace("\t", 4*" ")
-            self.text_area.insert("1.0", file_content)
+        if self.text is not None:
+            self.text_area.insert("1.0", self.text)
+            self.text = None
+            self.text_area.edit_modified(False)  # self.modified still tells if it differs from the file
             self.python_lexer()
+        elif self.file:
+            self.load_file(self.file)
+
+    def release(self):
+        # Removes the widgets, an unmodified file is read again when needed
+        if not self.materialized or self.loading:
+            return
+        if self.modified or self.text_area.edit_modified() or not self.file:
+            self.modified = True
+            self.text = self.text_area.get("1.0", "end-1c")
+        for after in (self.highlight_after, self.highlight_poll, self.line_numbers_after):
+            if after:
+                self.after_cancel(after)
+        self.lexer.generation += 1  # stops a running highlight job
+        for widget in (self.text_area, self.y_scrollbar, self.x_scrollbar, self.line_numbers):
+            widget.destroy()
+        del self.text_area, self.lexer, self.line_number_items, self.line_number_shown, self.highlight_pending
+        self.materialized = False
+
+    def load_file(self, file):
+        # The file is inserted chunk by chunk while Tk is idle, so a big file
+        # does not freeze the window. It is highlighted once it is complete.
+        self.loading = True
+        self.load_source = open(file, "rb")
+        self.load_size = os.fstat(self.load_source.fileno()).st_size
+        self.load_position = 0
+        self.load_data = self.load_source
+        if self.load_size >= LOAD_MMAP_SIZE:
+            self.load_data = mmap.mmap(self.load_source.fileno(), 0, access=mmap.ACCESS_READ)
+        # the same decoding and newline translation as open(file, "r")
+        self.load_decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors="replace"), translate=True)
+        self.text_area.config(state=tk.DISABLED)  # no typing into a half loaded file
+        self.load_progress = None
+        if self.load_size > LOAD_CHUNK:
+            self.load_progress = ttk.Progressbar(self, maximum=self.load_size)
+            self.load_progress.grid(row=2, column=0, columnspan=3, sticky="ew")
+        self.load_after = self.after_idle(self._load_chunk)
+
+    def _load_chunk(self):
+        if self.load_data is self.load_source:
+            data = self.load_source.read(LOAD_CHUNK)
+        else:
+            data = self.load_data[self.load_position:self.load_position + LOAD_CHUNK]
+        self.load_position += len(data)
+        text = self.load_decoder.decode(data, final=not data).replace("\t", 4*" ")
+
+        self.text_area.config(state=tk.NORMAL)
+        self.text_area.insert("end-1c", text)
+        if data:
+            self.text_area.config(state=tk.DISABLED)
+            if self.load_progress:
+                self.load_progress.config(value=self.load_position)
+            self.load_after = self.after(1, self._load_chunk)  # lets Tk handle pending events first
+            return
+
+        self._close_load()
+        self.text_area.edit_modified(False)
+        self.text_area.mark_set(tk.INSERT, "1.0")
+        self.text_area.see("1.0")
+        if self.load_progress:
+            self.load_progress.destroy()
+            self.load_progress = None
+        self.python_lexer()
+
+    def _close_load(self):
+        self.loading = False
+        self.load_after = None
+        if self.load_data is not self.load_source:
+            self.load_data.close()
+        self.load_source.close()
+
+    def destroy(self):
+        # A tab closed while loading stops the load and closes the file
+        if self.loading:
+            self.after_cancel(self.load_after)
+            self._close_load()
+        super().destroy()
+        if self.materialized:
+            self.tk.deletecommand(self.text_area._w)  # Tk deleted the renamed widget command
 
     def _set_text_tags(self):
         self.text_area.tag_config("Token.Text", foreground="black") 
@@ -91,25 +414,102 @@ class NotebookTab(ttk.Frame):
         self.text_area.tag_config("Token.Name", foreground="black") 
 
     def _key_event(self, event):
-        if self.text_area.edit_modified():
-            self.master.tab(self.master.select(), text=self.title+" *")
+        # The buffer is about to change, lines lexed so far refer to the old text
+        self.lexer.generation += 1
+        self.highlight_pending = []
 
-    def _release_key(self, event):
-        self.python_lexer()
+    def _modified_event(self, event):
+        # Any change of the text sets the flag, pasting with the mouse or dropping text included
+        if self.text_area.edit_modified() and not self.loading:
+            self.modified = True
+            self.master.tab(self, text=self.title+" *")
 
+    def _release_key(self, event):
+        self.schedule_line_numbers()
+        if self.highlight_after:
+            self.after_cancel(self.highlight_after)
+        self.highlight_after = self.after(HIGHLIGHT_DELAY, self.python_lexer)
+
+    def visible_lines(self):
+        # first and last line (0 based) shown in the text area
+        first = self.text_area.index("@0,0")
+        last = self.text_area.index("@0,%d" % self.text_area.winfo_height())
+        return int(first.split(".")[0]) - 1, int(last.split(".")[0]) - 1
+
+    @metrics.timed("lexer")
     def python_lexer(self):
-        for tag in self.text_area.tag_names():
-            self.text_area.tag_delete(tag)
-        self._set_text_tags()
-        data = self.text_area.get("1.0", "end-1c")
-        self.text_area.mark_set("range_start", "1.0")
-        print("------------------")
-        for token, content in lex(data, PythonLexer()):
-            master_token = ".".join(str(token).split(".")[0:2])
-            self.text_area.mark_set("range_end", "range_start + %dc" % len(content))
-            self.text_area.tag_add(str(master_token), "range_start", "range_end")
-            print(token, len(content), content.encode())
-            self.text_area.mark_set("range_start", "range_end")
+        self.highlight_after = None
+        if not self.highlight or self.loading:
+            return
+        self.lexer.edit(self.text_area.get("1.0", "end-1c").split("\n"))
+        if all(self.lexer.clean):
+            self.highlight_done = True
+            return
+        self.highlight_pending = []  # results of the old job are stale now
+        self.highlight_done = False
+        self.highlight_thread.submit(self.lexer, self.highlight_results, self.visible_lines()[1])
+        if self.highlight_poll is None:
+            self._poll_highlight()
+
+    def _poll_highlight(self):
+        while True:
+            try:
+                generation, items, done = self.highlight_results.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.lexer.generation:
+                self.highlight_pending.extend(items)
+                self.highlight_done = done
+
+        if self.highlight_pending:
+            # colour the visible lines first, the rest in small slices
+            first, last = self.visible_lines()
+            visible = [item for item in self.highlight_pending if first <= item[0] <= last]
+            rest = [item for item in self.highlight_pending if not first <= item[0] <= last]
+            self._apply_highlight(visible + rest[:HIGHLIGHT_SLICE])
+            self.highlight_pending = rest[HIGHLIGHT_SLICE:]
+            metrics.gauge("highlight_pending", len(self.highlight_pending))
+
+        if self.highlight_done and not self.highlight_pending:
+            self.highlight_poll = None
+        else:
+            self.highlight_poll = self.after(10, self._poll_highlight)
+
+    @metrics.timed("highlight")
+    def _apply_highlight(self, items):
+        if not items:
+            return
+
+        # Remove old tags only from the re-lexed lines
+        items.sort(key=lambda item: item[0])
+        runs = []
+        for item in items:
+            line = item[0] + 1
+            if runs and runs[-1][1] == line:
+                runs[-1][1] = line + 1
+            else:
+                runs.append([line, line + 1])
+        for tag in self.highlight_tags:
+            for start, end in runs:
+                self.text_area.tag_remove(tag, "%d.0" % start, "%d.0" % end)
+
+        # Collect neighbouring tokens of the same type into ranges and add
+        # every tag with a single Tk call
+        ranges = {}
+        for line, start, tokens, end in items:
+            self.lexer.commit(line, start, end)
+            last_tag, last_end = None, None
+            for col, length, tag in tokens:
+                indices = ranges.setdefault(tag, [])
+                if tag == last_tag and col == last_end:
+                    indices[-1] = "%d.%d" % (line + 1, col + length)
+                else:
+                    indices.append("%d.%d" % (line + 1, col))
+                    indices.append("%d.%d" % (line + 1, col + length))
+                last_tag, last_end = tag, col + length
+        for tag, indices in ranges.items():
+            self.text_area.tag_add(tag, *indices)
+        self.highlight_tags.update(ranges)
 
     def _tab_event(self, event):
         self.text_area.insert(tk.INSERT, " " * 4)
@@ -123,37 +523,141 @@ class NotebookTab(ttk.Frame):
         self.text_area.tag_add("sel", "1.0", "end")
         return 'break'
 
+    def _text_command(self, operation, *args):
+        try:
+            result = self.tk.call(self.text_widget_command, operation, *args)
+        except tk.TclError:
+            # raised here it would stop the mainloop, even where the Tk
+            # bindings expect it, like deleting the selection when there is none
+            return ""
+        if operation in ("insert", "delete", "replace"):
+            self.schedule_line_numbers()
+        return result
+
+    def _yscroll_event(self, first, last):
+        self.y_scrollbar.set(first, last)
+        self.schedule_line_numbers()
+
+    def schedule_line_numbers(self, event=None):
+        # Several events in a row cause only one redraw
+        if self.line_numbers_after is None:
+            self.line_numbers_after = self.after_idle(self.update_line_numbers)
+
+    @metrics.timed("gutter")
     def update_line_numbers(self):
-        line = self.text_area.index('@0,0')
-        if (self.last_line_number != line) or (self.last_line_number is None):
-            self.line_numbers.delete("all")
-
-            while True:
-                dline = self.text_area.dlineinfo(line)
-                if dline is None:
-                    break
-                y = dline[1]
-                linenum = str(line).split(".")[0]
-                self.line_numbers.create_text(2, y, anchor="nw", text=linenum)
-                line = self.text_area.index("%s+1line" % line)
-
-            self.last_line_number = line
+        self.line_numbers_after = None
+        line = int(self.text_area.index("@0,0").split(".")[0])
+        last_line = int(self.text_area.index("end-1c").split(".")[0])
+
+        shown = 0
+        while line <= last_line:
+            dline = self.text_area.dlineinfo("%d.0" % line)
+            if dline is None:
+                break
+            if shown == len(self.line_number_items):
+                self.line_number_items.append(self.line_numbers.create_text(2, 0, anchor="nw"))
+                self.line_number_shown.append(None)
+            item = self.line_number_items[shown]
+            text, y = str(line), dline[1]
+            if self.line_number_shown[shown] != (text, y):
+                if self.line_number_shown[shown] is None:
+                    self.line_numbers.itemconfigure(item, state="normal")
+                self.line_numbers.itemconfigure(item, text=text)
+                self.line_numbers.coords(item, 2, y)
+                self.line_number_shown[shown] = (text, y)
+            shown += 1
+            line += 1
+
+        # Hide the items which are not needed now, they are kept for later
+        for index in range(shown, len(self.line_number_items)):
+            if self.line_number_shown[index] is not None:
+                self.line_numbers.itemconfigure(self.line_number_items[index], state="hidden")
+                self.line_number_shown[index] = None
 
     def save_file(self):
+        if self.loading:
+            return  # saving now would cut the file off
         if self.file and os.path.exists(self.file):
             with open(self.file, "w") as f:
                 f.write(self.text_area.get(1.0, tk.END)[:-1]) # Text.get adds \n to the end, so this must be cut with [:-1]
+            self.modified = False
+            self.text_area.edit_modified(False)
             self.master.tab(self.master.select(), text=self.title)
         else:
             self.file = filedialog.asksaveasfilename(initialdir = "",title = "Save File",filetypes = (("python files","*.py"),("all files","*.*")))
             with open(self.file, "w") as f:
                 f.write(self.text_area.get(1.0, tk.END))
+            self.modified = False
+            self.text_area.edit_modified(False)
             self.title = os.path.basename(self.file)
             self.master.tab(self.master.select(), text=self.title)
 
 
+class DeviceWatcher(threading.Thread):
+    # Keeps the list of USB serial devices up to date in the background, so
+    # enumerating the ports never blocks the Tk thread. On Linux it waits for
+    # udev events when pyudev is installed, otherwise it only enumerates the
+    # ports again when the entries in /sys/class/tty change. Elsewhere the
+    # ports are enumerated every DEVICE_POLL_INTERVAL seconds.
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.name = "DeviceWatcher"
+        self.devices = []  # the USB serial devices found by the last scan
+        self.events = queue.Queue()  # ("added" or "removed", device), handled on the Tk thread
+        self.start()
+
+    def scan(self):
+        return usb_serial_devices()
+
+    def update(self):
+        devices = self.scan()
+        for device in devices:
+            if device not in self.devices:
+                self.events.put(("added", device))
+        for device in self.devices:
+            if device not in devices:
+                self.events.put(("removed", device))
+        self.devices = devices
+
+    def udev_monitor(self):
+        try:
+            import pyudev
+        except ImportError:
+            return None
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by("tty")
+            monitor.start()
+        except (OSError, pyudev.DeviceNotFoundError) as e:
+            logging.warning("No udev events (%s), polling for serial devices", e)
+            return None
+        return monitor
+
+    def signature(self):
+        # Cheap to read summary of the ports, None when there is none
+        try:
+            return os.listdir("/sys/class/tty")
+        except OSError:
+            return None
+
+    def run(self):
+        self.update()
+        monitor = self.udev_monitor()
+        if monitor:
+            for device in iter(monitor.poll, None):
+                self.update()
+        last_signature = self.signature()
+        while True:
+            sleep(DEVICE_POLL_INTERVAL)
+            signature = self.signature()
+            if signature is None or signature != last_signature:
+                last_signature = signature
+                self.update()
+
+
 class SerialSetupWindow(tk.Toplevel):
-    def __init__(self, master, command):
+    def __init__(self, master, command, device_watcher):
         super().__init__(master)
         self.title("Connect to Serial Device")
         self.attributes("-topmost", True)
@@ -162,24 +666,20 @@ class SerialSetupWindow(tk.Toplevel):
         self.columnconfigure(0, weight=1)
         self.resizable(0, 0) # disable resizing by user
         self.command = command
+        self.device_watcher = device_watcher
         self.usb_devices = None
         self.buttons = []
 
         center_window(self)
-        self.update_serial_devices()
+        self.update_serial_devices()  # the Editor calls it again when a board is plugged in or removed
 
     def button_pressed(self, device):
         self.command(device)
         self.grab_release() # to return to normal
         self.destroy()
 
-    def get_serial_devices(self):
-        ports = list(serial.tools.list_ports.comports()) # get all serial devices
-        return [dev.device for dev in ports if "USB" in dev.hwid] # return a list of their names (COMx or dev/ttyUSBx)
-        # return [dev.device for dev in ports]
-
     def update_serial_devices(self):
-        usb_devices = self.get_serial_devices()
+        usb_devices = self.device_watcher.devices
         if usb_devices != self.usb_devices:
             self.usb_devices = usb_devices
             for button in self.buttons:
@@ -189,8 +689,6 @@ class SerialSetupWindow(tk.Toplevel):
                 self.buttons.append(tk.Button(self, text=device, command=lambda dev=device: self.button_pressed(dev)))
                 self.buttons[-1].grid(sticky="ew")
 
-        self.after(1000, self.update_serial_devices)
-
 
 class Editor(tk.Frame):
     def __init__(self, master):
@@ -200,9 +698,17 @@ class Editor(tk.Frame):
         self.rowconfigure(0, weight=1)
         self.repl = None
         self.u_serial = None
+        self.file_manager = None
+        self.minify_upload = MINIFY_UPLOAD
+        self.device = None  # the board selected in the REPL area, the toolbar works with it
+        self.sessions = {}  # device -> DeviceSession of every connected board
+        self.lost_devices = set()  # boards which were disconnected, they reconnect when plugged in
+        self.setup_window = None
+        self.device_watcher = DeviceWatcher()
 
         self.tab_close_style()  # for tab closing
 
+        self.highlight_thread = HighlightThread()
         self.notebook_tabs = []
         self.notebook = ttk.Notebook(self, style="ButtonNotebook") # 'style' for tab closing
         self.notebook.pressed_index = None  # for tab closing
@@ -211,13 +717,19 @@ class Editor(tk.Frame):
         self.notebook.grid(row=0, sticky="nsew")
         self.notebook.columnconfigure(0, weight=1)
         self.notebook.rowconfigure(0, weight=1)
-        self.new_tab()
-
-        self.line_number_update_timer()
+        self.recent_tabs = []  # materialized tabs, the most recently selected last
+        if not self.restore_session():
+            self.new_tab()
+        # bound after the restore, the tabs selected while adding them stay empty
+        self.notebook.bind("<<NotebookTabChanged>>", self._tab_changed)
 
         self.repl_visible = False
+        # one REPL per connected board, selecting it makes the board the current one
+        self.repl_notebook = ttk.Notebook(self)
+        self.repl_notebook.bind("<<NotebookTabChanged>>", self._session_changed)
         
         self.setup_device()
+        self.after(DEVICE_EVENT_POLL, self._poll_devices)
 
     def tab_close_style(self): # for tab closing
         imgdir = os.path.join(os.path.dirname(__file__), 'img')
@@ -259,11 +771,14 @@ class Editor(tk.Frame):
         index = widget.index("@%d,%d" % (x, y))
 
         if "close" in elem and widget.pressed_index == index:
+            closed_tab = self.notebook_tabs.pop(index)  # before the selection changes
+            if closed_tab in self.recent_tabs:
+                self.recent_tabs.remove(closed_tab)
             widget.forget(index)
             widget.event_generate("<<NotebookClosedTab>>")
+            closed_tab.destroy()
 
         widget.state(["!pressed"])
-        self.notebook_tabs.pop(widget.pressed_index)
         widget.pressed_index = None
         if len(self.notebook_tabs) == 0:
             self.new_tab()
@@ -278,30 +793,104 @@ class Editor(tk.Frame):
             widget.pressed_index = index
 
     def setup_device(self):
-        SerialSetupWindow(self, self.connect)
+        self.setup_window = SerialSetupWindow(self, self.connect, self.device_watcher)
+
+    def _poll_devices(self):
+        changed = False
+        while True:
+            try:
+                event, device = self.device_watcher.events.get_nowait()
+            except queue.Empty:
+                break
+            changed = True
+            if event == "removed" and device in self.sessions:
+                logging.info("%s was unplugged", device)
+                self.sessions[device].repl.disconnect(lost=True)
+            if event == "removed" and device in self.lost_devices:
+                self.master.bottom_status_bar.change_status(device, lost=True)
+            elif event == "added" and device in self.lost_devices:
+                logging.info("%s is back, reconnecting", device)
+                try:
+                    self.connect(device)
+                except (serial.SerialException, OSError) as e:
+                    logging.warning("Reconnecting to %s failed: %s", device, e)
+        if changed and self.setup_window and self.setup_window.winfo_exists():
+            self.setup_window.update_serial_devices()
+        self.after(DEVICE_EVENT_POLL, self._poll_devices)
 
     def connect(self, device):
-        if self.repl:
-            self.repl.disconnect()
-        if self.u_serial:
-            self.u_serial.close()
-        self.u_serial = uSerial(device)
-        self.repl = Repl(self, self.u_serial)
+        # Boards are connected in addition to the ones already connected
+        if device in self.sessions:
+            self.repl_notebook.select(self.sessions[device].repl)
+            return
+        u_serial = uSerial(device)
+        repl = Repl(self.repl_notebook, u_serial)
+        repl.bind("<<ReplDisconnected>>", lambda event: self.disconnected(device))
+        self.sessions[device] = DeviceSession(device, u_serial, repl, FileManager(self, u_serial))
+        self.lost_devices.discard(device)
+        self.repl_notebook.add(repl, text=device)
+        self.repl_notebook.select(repl)
+        self._session_changed()
         self.toggle_repl(True) # set REPL to visible
-        self.master.update_title(device)
-        self.master.bottom_status_bar.change_status(device)
-        self.master.tool_bar.update_device_image(alert=False)
         self.master.root.lift() # After connecting to a device, ensure the Editor is on the top
 
-    def line_number_update_timer(self):
-        self.selected_tab_object().update_line_numbers()
-        self.master.after(60, self.line_number_update_timer)
+    def disconnected(self, device):
+        session = self.sessions.pop(device, None)
+        if session is None:
+            return
+        if session.repl.lost:
+            self.lost_devices.add(device)
+        if session.file_manager is self.file_manager:
+            self.file_manager = None
+        session.file_manager.destroy()
+        self.repl_notebook.forget(session.repl)
+        session.repl.destroy()
+        self._session_changed()
+        if not self.sessions:
+            self.set_repl_invisible()
 
-    def _add_tab(self, title, file):
-        new_tab = NotebookTab(self.notebook, title, file)
+    def _session_changed(self, event=None):
+        # The toolbar, the Storage panel and the status bar work with the selected board
+        files_shown = self.file_manager is not None and self.file_manager.winfo_ismapped()
+        if files_shown:
+            self.file_manager.grid_remove()
+        selected = self.repl_notebook.select()
+        session = next((session for session in self.sessions.values() if str(session.repl) == selected), None)
+        self.device = session.device if session else None
+        self.u_serial = session.u_serial if session else None
+        self.repl = session.repl if session else None
+        self.file_manager = session.file_manager if session else None
+        if files_shown and self.file_manager:
+            self.file_manager.grid(row=0, column=1, sticky="ns")
+        self.master.update_title(self.device)
+        self.master.bottom_status_bar.change_status(self.device)
+        self.master.tool_bar.update_device_image(alert=session is None)
+
+    def broadcast(self):
+        if self.sessions:
+            BroadcastWindow(self, self.sessions, self.tab_source, self.tab_project_modules, self.tab_modules)
+
+    def _add_tab(self, title, file, select=True):
+        new_tab = NotebookTab(self.notebook, title, file, self.highlight_thread)
         self.notebook_tabs.append(new_tab)
         self.notebook.add(new_tab, text=title)
-        self.notebook.select(new_tab)
+        if select:
+            self.notebook.select(new_tab)
+            self._tab_changed()
+
+    def _tab_changed(self, event=None):
+        # The selected tab gets its widgets, the least recently used ones lose them
+        if not self.notebook.select():
+            return
+        tab = self.selected_tab_object()
+        tab.materialize()
+        if tab in self.recent_tabs:
+            self.recent_tabs.remove(tab)
+        self.recent_tabs.append(tab)
+        for old_tab in self.recent_tabs[:-TAB_WIDGETS_KEPT] if TAB_WIDGETS_KEPT else []:
+            old_tab.release()
+            if not old_tab.materialized:
+                self.recent_tabs.remove(old_tab)
 
     def selected_tab_index(self):
         return self.notebook.index(self.notebook.select())
@@ -309,17 +898,95 @@ class Editor(tk.Frame):
     def selected_tab_object(self):
         return self.notebook_tabs[self.selected_tab_index()]
 
+    def save_session(self):
+        # Remembers the open files, the next start only loads the selected one
+        files = [tab for tab in self.notebook_tabs if tab.file]
+        selected = self.selected_tab_object() if self.notebook.select() else None
+        session = {
+            "tabs": [{"title": tab.title, "file": tab.file} for tab in files],
+            "selected": files.index(selected) if selected in files else 0,
+        }
+        try:
+            with open(SESSION_FILE, "w") as f:
+                json.dump(session, f, indent=2)
+        except OSError as e:
+            logging.warning("Session not saved: %s", e)
+
+    def restore_session(self):
+        try:
+            with open(SESSION_FILE) as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return False
+        tabs = [tab for tab in session.get("tabs", []) if os.path.isfile(tab["file"])]
+        for tab in tabs:
+            self._add_tab(tab["title"], tab["file"], select=False)
+        if not tabs:
+            return False
+        self.notebook.select(min(session.get("selected", 0), len(tabs) - 1))
+        self._tab_changed()
+        return True
+
+    def tab_source(self):
+        source = self.selected_tab_object().text_area.get(1.0, tk.END)
+        if self.minify_upload:
+            minified = minify(source)
+            logging.info("Minified %d to %d bytes", len(source), len(minified))
+            source = minified
+        return source.encode()
+
+    def tab_project_modules(self):
+        # The modules next to the file of the selected tab which it imports,
+        # the unsaved changes of open tabs included
+        tab = self.selected_tab_object()
+        if not tab.file:
+            return {}
+        sources = {}
+        for other in self.notebook_tabs:
+            if other.file and other.modified:
+                text = other.text_area.get("1.0", "end-1c") if other.materialized else other.text
+                sources[os.path.abspath(other.file)] = text
+        modules = {}
+        for name, path in import_graph.modules(tab.text_area.get("1.0", "end-1c"),
+                                               os.path.dirname(os.path.abspath(tab.file)), sources):
+            if path == os.path.abspath(tab.file):
+                continue  # the tab itself is sent by Run
+            if path in sources:
+                source = sources[path]
+            else:
+                with open(path) as f:
+                    source = f.read()
+            modules[name] = (minify(source) if self.minify_upload else source).encode()
+        return modules
+
+    def tab_modules(self):
+        # Modules edited in the tabs, a warm run imports them again
+        return {os.path.splitext(tab.title)[0] for tab in self.notebook_tabs
+                if tab.file and tab.file.lower().endswith(".py")}
+
     def run_tab(self):
         self.set_repl_visible()
         if self.u_serial:
-            self.u_serial.run(self.selected_tab_object().text_area.get(1.0, tk.END).encode())
+            modules = self.tab_project_modules()
+            run_thread = RunThread(self.u_serial, self.repl, self.tab_source(), self.tab_modules() - modules.keys(),
+                                   modules)
+            self._ran(run_thread, self.file_manager)
+
+    def _ran(self, run_thread, file_manager):
+        # The Storage panel lists the folders again in which the run wrote modules
+        try:
+            written = run_thread.messages.get_nowait()
+        except queue.Empty:
+            self.after(100, self._ran, run_thread, file_manager)
+            return
+        if written and file_manager.winfo_exists():
+            file_manager.invalidate(written)
 
     def new_tab(self, title="untitled", file=None):
-        if len(self.notebook_tabs) < 10:
-            self._add_tab(title, file)
+        self._add_tab(title, file)
 
     def toggle_repl(self, visibility=None):
-        if not self.repl:
+        if not self.sessions:
             return
         
         if visibility is None:    
@@ -333,18 +1000,24 @@ class Editor(tk.Frame):
             self.set_repl_invisible()
 
     def set_repl_visible(self):
-        if not self.repl:
+        if not self.sessions:
             return
 
         self.repl_visible = True
-        self.repl.grid(row=1, sticky="we")
+        self.repl_notebook.grid(row=1, sticky="we")
 
-    def set_repl_invisible(self):
-        if not self.repl:
+    def toggle_files(self):
+        if not self.file_manager:
             return
-        
+
+        if self.file_manager.winfo_ismapped():
+            self.file_manager.grid_remove()
+        else:
+            self.file_manager.grid(row=0, column=1, sticky="ns")
+
+    def set_repl_invisible(self):
         self.repl_visible = False
-        self.repl.grid_remove()
+        self.repl_notebook.grid_remove()
 
     def save_file(self):
         self.selected_tab_object().save_file()
@@ -355,17 +1028,334 @@ class Editor(tk.Frame):
             self.new_tab(file=file_path, title=os.path.basename(file_path))
 
 
+class DeviceSession:
+    # A connected board with its REPL and Storage panel
+    def __init__(self, device, u_serial, repl, file_manager):
+        self.device = device
+        self.u_serial = u_serial
+        self.repl = repl
+        self.file_manager = file_manager
+
+
+class BroadcastWindow(tk.Toplevel):
+    # Runs the selected tab or syncs a folder on several boards at once. Every
+    # board gets its own BroadcastThread, so the whole group takes about as
+    # long as the slowest board.
+    def __init__(self, master, sessions, source, modules, edited):
+        super().__init__(master)
+        self.title("Run on several devices")
+        self.minsize(400, 100)
+        self.columnconfigure(1, weight=1)
+        self.sessions = sessions
+        self.source = source  # returns the code of the selected tab
+        self.modules = modules  # returns the local modules it imports
+        self.edited = edited  # returns the modules edited in the tabs, a warm run imports them again
+        self.messages = queue.Queue()  # (device, "progress"/"done"/"failed", value) from the threads
+        self.running = 0
+        self.done = None
+
+        self.selected = {}
+        self.status = {}
+        for row, device in enumerate(sessions):
+            self.selected[device] = tk.BooleanVar(value=True)
+            tk.Checkbutton(self, text=device, variable=self.selected[device]).grid(row=row, column=0, sticky="w")
+            self.status[device] = tk.Label(self, anchor="w")
+            self.status[device].grid(row=row, column=1, sticky="ew")
+
+        buttons = tk.Frame(self)
+        buttons.grid(row=len(sessions), column=0, columnspan=2, sticky="ew")
+        self.run_button = tk.Button(buttons, text="Run tab", command=self.run_tab)
+        self.run_button.grid(row=0, column=0)
+        self.sync_button = tk.Button(buttons, text="Sync folder", command=self.sync_directory)
+        self.sync_button.grid(row=0, column=1)
+        self.summary = tk.Label(self, anchor="w")
+        self.summary.grid(row=len(sessions) + 1, column=0, columnspan=2, sticky="ew")
+        center_window(self)
+
+    def run_tab(self):
+        # like Run in the editor, built once for all boards
+        source, modules = self.source(), self.modules()
+        reload = self.edited() - modules.keys()
+        self.start(lambda u_serial, progress: u_serial.run(source, reload=reload, modules=modules),
+                   lambda session, written: session.file_manager.invalidate(written))
+
+    def sync_directory(self):
+        local_dir = filedialog.askdirectory(parent=self, title="Folder to copy to the devices")
+        if not local_dir:
+            return
+
+        def job(u_serial, progress):
+            with u_serial.raw_repl():
+                return FileSync(u_serial, progress).sync_directory(local_dir)
+        self.start(job, lambda session, written: session.file_manager.invalidate(written))
+
+    def start(self, job, done=None):
+        # job(u_serial, progress) runs in a thread per board, done(session, result) on the Tk thread
+        devices = [device for device, selected in self.selected.items() if selected.get() and device in self.sessions]
+        if self.running or not devices:
+            return
+        self.done = done
+        self.running = len(devices)
+        self.failed = 0
+        self.slowest = 0
+        self.start_time = time()
+        for device in devices:
+            self.status[device].config(text="started", fg="black")
+            BroadcastThread(device, self.sessions[device].u_serial, job, self.messages)
+        self.run_button.config(state=tk.DISABLED)
+        self.sync_button.config(state=tk.DISABLED)
+        self.summary.config(text="")
+        self._show_messages()
+
+    def _show_messages(self):
+        if not self.winfo_exists():
+            return  # closed while the threads were running
+        while True:
+            try:
+                device, state, value = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if state == "progress":
+                self.status[device].config(text=value)
+                continue
+            self.running -= 1
+            if state == "done":
+                seconds, result = value
+                self.slowest = max(self.slowest, seconds)
+                self.status[device].config(text="done in {:.1f} s".format(seconds), fg="dark green")
+                if self.done and device in self.sessions:
+                    self.done(self.sessions[device], result)
+            else:
+                self.failed += 1
+                self.status[device].config(text="failed: {}".format(value), fg="red")
+
+        if self.running:
+            self.after(100, self._show_messages)
+        else:
+            self.summary.config(text="Finished in {:.1f} s, slowest device {:.1f} s, {} failed".format(
+                time() - self.start_time, self.slowest, self.failed))
+            self.run_button.config(state=tk.NORMAL)
+            self.sync_button.config(state=tk.NORMAL)
+
+
+class RunThread(threading.Thread):
+    # Runs the code of a tab, the module cache update and the upload take
+    # seconds on a slow board and must not block the Tk thread. The program
+    # output comes through the SerialThread, errors go to the REPL.
+
+    def __init__(self, u_serial, repl, source, reload, modules):
+        super().__init__(daemon=True)
+        self.name = "RunThread"
+        self.u_serial = u_serial
+        self.repl = repl
+        self.source = source
+        self.reload = reload
+        self.modules = modules
+        self.messages = queue.Queue()  # the paths written on the device, when the run ends
+        self.start()
+
+    def run(self):
+        try:
+            written = self.u_serial.run(self.source, reload=self.reload, modules=self.modules)
+        except (uSerialError, serial.SerialException, OSError) as e:
+            self.repl.receive_queue.put("\n{}\n".format(e))
+            written = ModuleCache.paths(self.modules) if self.modules else []  # some may have been sent
+        self.messages.put(written)
+
+
+class BroadcastThread(threading.Thread):
+    # Runs a BroadcastWindow job on one board
+
+    def __init__(self, device, u_serial, job, messages):
+        super().__init__(daemon=True)
+        self.name = "BroadcastThread"
+        self.device = device
+        self.u_serial = u_serial
+        self.job = job
+        self.messages = messages
+        self.start()
+
+    def run(self):
+        start = time()
+        try:
+            result = self.job(self.u_serial, lambda message: self.messages.put((self.device, "progress", message)))
+            self.messages.put((self.device, "done", (time() - start, result)))
+        except Exception as e:
+            # the window waits for every board, so no error may get lost
+            logging.exception("%s failed", self.device)
+            self.messages.put((self.device, "failed", e))
+
+
 class FileManager(tk.Frame):
     def __init__(self, master, u_serial):
         super().__init__(master)
+        self.u_serial = u_serial
+        self.messages = queue.Queue()  # filled by the FileTransferThread, None when it ends
+        self.jobs = []  # (job, done) waiting for the FileTransferThread
+        self.transfer_thread = None
+        self.listings = {}  # cached directory listings, path -> [(name, is_dir, size)]
         self.grid_columnconfigure(0, weight=1)
-        self.t = tk.Text(self)
-        self.t.grid(row=0, sticky="nsew")
+        self.grid_columnconfigure(1, weight=1)
+        self.grid_columnconfigure(2, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+
+        tk.Button(self, text="Sync folder", command=self.sync_directory).grid(row=0, column=0, sticky="ew")
+        tk.Button(self, text="Upload file", command=self.upload_file).grid(row=0, column=1, sticky="ew")
+        tk.Button(self, text="Refresh", command=self.refresh).grid(row=0, column=2, sticky="ew")
+
+        # Directories are listed when they are opened for the first time
+        self.tree = ttk.Treeview(self, columns=("size",))
+        self.tree.heading("#0", text="Device")
+        self.tree.heading("size", text="Size")
+        self.tree.column("size", width=70, anchor="e")
+        self.tree.grid(row=1, column=0, columnspan=3, sticky="nsew")
+        self.tree.bind("<<TreeviewOpen>>", self._open_event)
+        self.tree.bind("<Map>", self._map_event)
+
+        self.t = tk.Text(self, width=40, height=8, state=tk.DISABLED)
+        self.t.grid(row=2, column=0, columnspan=3, sticky="nsew")
+
+    def log(self, message):
+        self.t.config(state=tk.NORMAL)
+        self.t.insert(tk.END, message + "\n")
+        self.t.see(tk.END)
+        self.t.config(state=tk.DISABLED)
+
+    def _map_event(self, event):
+        self.invalidate([])
+
+    def _open_event(self, event):
+        path = self.tree.focus()
+        if path in self.listings:
+            self._show_listing(path)
+        else:
+            self.list_dirs([path])
+
+    def list_dirs(self, paths):
+        self.start_transfer(lambda sync: sync.list_dirs(paths), self._listed)
+
+    def _listed(self, listings, seconds):
+        self.listings.update(listings)
+        for path in listings:
+            self._show_listing(path)
+
+    def _show_listing(self, path):
+        if path != "/" and not self.tree.exists(path):
+            return  # the parent was collapsed into a placeholder meanwhile
+        parent = "" if path == "/" else path
+        children = self.tree.get_children(parent)
+        if children:
+            self.tree.delete(*children)
+        for name, is_dir, size in sorted(self.listings[path], key=lambda entry: (not entry[1], entry[0])):
+            child = path.rstrip("/") + "/" + name
+            if is_dir:
+                self.tree.insert(parent, tk.END, iid=child, text=name + "/")
+                if child in self.listings:
+                    self._show_listing(child)
+                else:
+                    self.tree.insert(child, tk.END, text="...")  # placeholder, makes the node expandable
+            else:
+                self.tree.insert(parent, tk.END, iid=child, text=name, values=(size,))
+
+    def invalidate(self, remote_paths):
+        # Forgets the listings of the directories containing remote_paths
+        for remote_path in remote_paths:
+            remote_path = "/" + remote_path.lstrip("/")
+            self.listings.pop(remote_path.rsplit("/", 1)[0] or "/", None)
+        if not self.winfo_ismapped():
+            return  # listed when the panel is shown again
+
+        # The shown directories missing in the cache are listed with a single round trip
+        shown = ["/"]
+        stack = list(self.tree.get_children(""))
+        while stack:
+            item = stack.pop()
+            if self.tree.item(item, "open"):
+                shown.append(item)
+                stack.extend(self.tree.get_children(item))
+        missing = [path for path in shown if path not in self.listings]
+        if missing:
+            self.list_dirs(missing)
+
+    def refresh(self):
+        self.listings = {}
+        self.invalidate([])
+
+    def sync_directory(self):
+        local_dir = filedialog.askdirectory(title="Folder to copy to the device")
+        if local_dir:
+            self.start_transfer(lambda sync: sync.sync_directory(local_dir), self._transferred)
+
+    def upload_file(self):
+        # A script is sent with the local modules it imports
+        local_path = filedialog.askopenfilename(title="File to copy to the device")
+        if local_path.lower().endswith(".py"):
+            self.start_transfer(lambda sync: sync.sync_script(local_path), self._transferred)
+        elif local_path:
+            remote_path = os.path.basename(local_path)
+            self.start_transfer(lambda sync: [remote_path] if sync.upload_file(local_path, remote_path) else [],
+                                self._transferred)
+
+    def _transferred(self, written, seconds):
+        self.log("Done in {:.1f} s, {} file(s) sent".format(seconds, len(written)))
+        self.invalidate(written)
+
+    def start_transfer(self, job, done):
+        # Jobs run one after the other, done(result, seconds) is called on the Tk thread
+        self.jobs.append((job, done))
+        if not (self.transfer_thread and self.transfer_thread.is_alive()):
+            self._next_transfer()
+
+    def _next_transfer(self):
+        if self.jobs:
+            self.transfer_thread = FileTransferThread(self, *self.jobs.pop(0))
+            self._show_messages()
+
+    def _show_messages(self):
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                self._next_transfer()
+                return
+            if callable(message):
+                message()
+            else:
+                self.log(message)
+        self.after(100, self._show_messages)
+
+
+class FileTransferThread(threading.Thread):
+    # Runs a FileSync job in the raw REPL without blocking the Tk thread
+
+    def __init__(self, file_manager, job, done):
+        super().__init__(daemon=True)
+        self.name = "FileTransferThread"
+        self.file_manager = file_manager
+        self.job = job
+        self.done = done
+        self.start()
+
+    def run(self):
+        messages = self.file_manager.messages
+        start = time()
+        try:
+            with self.file_manager.u_serial.raw_repl():
+                result = self.job(FileSync(self.file_manager.u_serial, messages.put))
+            seconds = time() - start
+            messages.put(lambda: self.done(result, seconds))
+        except (uSerialError, serial.SerialException, OSError) as e:
+            messages.put("Transfer failed: {}".format(e))
+        messages.put(None)
 
 
 class Repl(tk.Frame):
-    def __init__(self, master, u_serial):
+    def __init__(self, master, u_serial, scrollback=REPL_SCROLLBACK, log_file=REPL_LOG_FILE):
         super().__init__(master)
+        self.scrollback = scrollback
+        self.session_log = self._open_session_log(log_file, u_serial.port) if log_file else None
         self.grid_columnconfigure(0, weight=1)
         self.repl_text_field = tk.Text(self)
         self.repl_text_field.grid(row=0, column=0, sticky="ew")
@@ -374,6 +1364,7 @@ class Repl(tk.Frame):
         self.repl_scrollbar.config(command=self.repl_text_field.yview)
         self.repl_stop = self.repl_text_field.index("end")
         self.send_queue = queue.Queue()
+        self.receive_queue = queue.Queue()  # filled by the SerialThread, None means the port failed
 
         self.repl_text_field.config(
             height=15,
@@ -396,7 +1387,10 @@ class Repl(tk.Frame):
         self.repl_text_field.bind("<Control-e>", self._ctrl_e_event)
         self.repl_text_field.bind("<Control-E>", self._ctrl_e_event)
 
+        self.u_serial = u_serial
         self.serial_thread = SerialThread(self, u_serial)
+        self.render_after = None
+        self._render_output()
 
     def _key_event(self, event):
         if event.keysym == "Left" and self.repl_text_field.compare(self.repl_text_field.index(tk.INSERT), '==', self.repl_stop):
@@ -439,17 +1433,75 @@ class Repl(tk.Frame):
         self.send_queue.put(chr(5).encode())
         return "break"
 
-    def disconnect(self, wait_for_thread_join=True):
-        self.grid_remove()
-        self.serial_thread.isRunning = False
-        if wait_for_thread_join:
-            self.serial_thread.join()
-        self.master.u_serial.close()
-        self.master.u_serial = None
-        self.master.master.update_title(None)
-        self.master.master.tool_bar.update_device_image(alert=True)
-        self.master.master.bottom_status_bar.change_status(None)
-        self.master.repl = None
+    def _open_session_log(self, log_file, port):
+        # Raw REPL output is appended to log_file with the name of the port
+        # added, every board has a file and a logger of its own. The file is
+        # rotated when it gets too big.
+        device = "".join(c for c in os.path.basename(port) if c.isalnum() or c in "-_") or "device"
+        root, extension = os.path.splitext(log_file)
+        handler = logging.handlers.RotatingFileHandler(
+            "{}-{}{}".format(root, device, extension), maxBytes=REPL_LOG_SIZE, backupCount=REPL_LOG_BACKUPS,
+            encoding="utf-8")
+        handler.terminator = ""
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        session_log = logging.getLogger("repl_session." + device)
+        session_log.propagate = False  # keep the output away from the console log
+        session_log.setLevel(logging.INFO)
+        session_log.addHandler(handler)
+        return session_log
+
+    def _close_session_log(self):
+        for handler in list(self.session_log.handlers):
+            self.session_log.removeHandler(handler)
+            handler.close()
+        self.session_log = None
+
+    def _trim_scrollback(self):
+        lines = int(self.repl_text_field.index("end-1c").split(".")[0])
+        if lines > self.scrollback + REPL_TRIM_BATCH:
+            self.repl_text_field.delete("1.0", "%d.0" % (lines - self.scrollback + 1))
+
+    def _render_output(self):
+        # Everything received since the last frame is shown with a single insert
+        metrics.gauge("send_queue", self.send_queue.qsize())
+        metrics.gauge("receive_queue", self.receive_queue.qsize())
+        chunks = []
+        failed = False
+        while True:
+            try:
+                chunk = self.receive_queue.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is None:
+                failed = True
+                break
+            chunks.append(chunk)
+
+        if chunks:
+            with metrics.timer("repl_insert"):
+                self.repl_text_field.insert(tk.END, "".join(chunks))
+                self._trim_scrollback()
+            self.repl_text_field.mark_set(tk.INSERT, tk.END)
+            self.repl_text_field.see(tk.END)
+            self.repl_stop = self.repl_text_field.index("end-1c")
+
+        if failed:
+            self.render_after = None
+            self.disconnect(False, lost=True)
+        else:
+            self.render_after = self.after(1000 // REPL_REFRESH_RATE, self._render_output)
+
+    def disconnect(self, wait_for_thread_join=True, lost=False):
+        # lost is True when the board went away, it reconnects when it is back
+        self.lost = lost
+        if self.render_after:
+            self.after_cancel(self.render_after)
+            self.render_after = None
+        self.serial_thread.stop(wait_for_thread_join)
+        if self.session_log:
+            self._close_session_log()
+        self.u_serial.close()
+        self.event_generate("<<ReplDisconnected>>")  # the Editor removes the board's session
 
 
 class Toolbar(tk.Frame):
@@ -466,6 +1518,7 @@ class Toolbar(tk.Frame):
         self._add_separator("separator_1")
         self._add_separator("separator_2")
         self._add_button("run", "Run", "img/run.png")
+        self._add_button("broadcast", "Run all", "img/run0.png")
         self._add_button("repl", "REPL", "img/repl.png")
         self._add_button("files", "Storage", "img/files.png")
         self._add_button("device", "Connect", "img/device_alert.png")
@@ -473,16 +1526,34 @@ class Toolbar(tk.Frame):
 
 
     def _load_image(self, img_file):
-        # Load the image first as PNGs and use ImageTk to convert
-        # them to usable Tkinter image.
-        img = Image.open(img_file)
-        img = img.resize((40, 40), Image.ANTIALIAS)
-        img = ImageTk.PhotoImage(img)
-        
+        # The resized icons are cached in a format Tk reads by itself, so
+        # Pillow is only needed when an icon is newer than its cached copy
+        source = os.path.join(os.path.dirname(os.path.abspath(__file__)), img_file)
+        name = os.path.splitext(os.path.basename(img_file))[0]
+        cached = os.path.join(ICON_CACHE_DIR, "{}_{}.{}".format(
+            name, ICON_SIZE, "png" if tk.TkVersion >= 8.6 else "gif"))  # Tk reads PNG since 8.6
+        try:
+            fresh = os.path.getmtime(cached) >= os.path.getmtime(source)
+        except OSError:
+            fresh = False
+        img = tk.PhotoImage(file=cached) if fresh else self._resize_image(source, cached)
+
         # The image must be stored somewhere forever
         self.images[img_file] = img
         return self.images[img_file]
 
+    def _resize_image(self, source, cached):
+        from PIL import Image, ImageTk # requires installing
+        img = Image.open(source).convert("RGBA")
+        img = img.resize((ICON_SIZE, ICON_SIZE), Image.LANCZOS)
+        try:
+            os.makedirs(ICON_CACHE_DIR, exist_ok=True)
+            img.save(cached + ".tmp", os.path.splitext(cached)[1][1:].upper())
+            os.replace(cached + ".tmp", cached)  # a half written icon is never read
+        except OSError as e:
+            logging.warning("Icon cache not written: %s", e)
+        return ImageTk.PhotoImage(img)
+
     def _add_button(self, name, label_text, img_file):
         new_button = tk.Button(self, image=self._load_image(img_file), border=0)
         new_button.grid(row=0, column=len(self.buttons))
@@ -505,48 +1576,13 @@ class Toolbar(tk.Frame):
             self.buttons["device"].config(image=self.images["img/device.png"])
 
 
-class uSerial(serial.Serial):
-    def __init__(self, port):
-        super().__init__(port, baudrate=115200, timeout=.2)
-        self.write(b'\r\x03\x03') # ctrl-C twice: interrupt any running program
-        self.write(b'\x04') # ctrl-D: soft reset
-        sleep(.2) # wait for the device to send a reply
-        self.flushInput() # flush the reply
-
-    def run(self, command):
-        self.enter_raw_repl()
-        self.exec(command)
-        self.exit_raw_repl()
-
-    def run_file(self, filename):
-        with open(filename, 'rb') as f:
-            pyfile = f.read()
-        self.run(pyfile)
-
-    def enter_raw_repl(self):
-        self.write(b'\r\x03\x03') # ctrl-C twice: interrupt any running program
-
-        self.flushInput()
-
-        self.write(b'\r\x01') # ctrl-A: enter raw REPL
-        sleep(.1)
-        self.write(b'\x04') # ctrl-D: soft reset
-        sleep(.5)
-
-    def exit_raw_repl(self):
-        self.write(b'\r\x02') # ctrl-B: enter friendly REPL
-
-    def exec(self, command):
-        command_bytes = command.rstrip() + b"\n\r"
-
-        # write command
-        for i in range(0, len(command_bytes), 256):
-            self.write(command_bytes[i:min(i + 256, len(command_bytes))])
-            sleep(0.01)
-        self.write(b'\x04')
-
-
 class SerialThread(threading.Thread):
+    # Shows the device output in the REPL and sends what is typed there.
+    # The reader blocks in select() on the port and the writer on the send
+    # queue, so an idle connection costs no CPU and an echo is shown as soon
+    # as it arrives. Both only touch the port while holding u_serial.lock,
+    # which run() and the file transfers hold for a whole raw REPL
+    # conversation, so nobody reads a reply meant for someone else.
 
     def __init__(self, repl, u_serial):
         super().__init__()
@@ -554,63 +1590,164 @@ class SerialThread(threading.Thread):
         self.repl = repl
         self.u_serial = u_serial
         self.isRunning = True
+        # multibyte characters split between two reads are joined by the decoder
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.bytes_received = 0
+        self.read_time = 0  # seconds spent reading and decoding
+        self.start_time = time()
+        # the port's file descriptor, None where select() cannot wait on it (Windows)
+        try:
+            self.fileno = u_serial.fileno()
+        except (io.UnsupportedOperation, AttributeError, ValueError, serial.SerialException):
+            self.fileno = None
+        self.wake_read, self.wake_write = os.pipe()  # wakes the reader when the thread is stopped
+        self.wake_lock = threading.Lock()  # the reader closes the pipe when it ends
+        self.writer = threading.Thread(target=self._write_loop, name="SerialWriter", daemon=True)
         self.start()
 
+    def stop(self, wait=True):
+        self.isRunning = False
+        self.repl.send_queue.put(None)  # wakes the writer
+        with self.wake_lock:
+            if self.wake_write is not None:
+                os.write(self.wake_write, b"\0")
+        if wait:
+            self.join()
+            if self.writer.ident is not None:  # run() starts it once the port is open
+                self.writer.join()
+
+    def read_available(self):
+        # Reads everything waiting in the input buffer with a single call
+        waiting = self.u_serial.inWaiting()
+        if not waiting:
+            return ""
+        return self.decode(self.u_serial.read(waiting))
+
+    def decode(self, data):
+        start = perf_counter()
+        incoming_message = self.decoder.decode(data).replace("\r", "")
+        elapsed = perf_counter() - start
+        metrics.record("serial_read", elapsed)
+        self.read_time += elapsed
+        self.bytes_received += len(data)
+        return incoming_message
+
+    def throughput(self):
+        # (received bytes/s since start, bytes/s the read path can sustain)
+        elapsed = time() - self.start_time
+        received = self.bytes_received / elapsed if elapsed else 0
+        capacity = self.bytes_received / self.read_time if self.read_time else 0
+        return received, capacity
+
+    def readable(self, timeout=None):
+        # Waits until the device sent something or the thread is stopped
+        if self.u_serial.unread:
+            return True  # left over from a raw REPL conversation, select() does not see it
+        if self.fileno is None:
+            # no select() on serial ports here, poll the input buffer instead
+            deadline = None if timeout is None else time() + timeout
+            while self.isRunning and not self.u_serial.inWaiting():
+                if deadline is not None and time() >= deadline:
+                    return False
+                sleep(.01)
+            return self.isRunning
+        ready = select.select([self.fileno, self.wake_read], [], [], timeout)[0]
+        return self.fileno in ready
+
     def run(self):
         logging.info('SerialThread Started')
         
-        if self.u_serial.is_open:
-            logging.info("Serial opened")
-        else:
-            logging.critical("Serial could not be open")
-            return
-
-        self.u_serial.write(b'\x04') # soft reset - the reply is the first thing printed in the REPL area
-        
-        while self.isRunning:
+        try:
+            if self.u_serial.is_open:
+                logging.info("Serial opened")
+            else:
+                logging.critical("Serial could not be open")
+                return
+
+            with self.u_serial.lock:
+                self.u_serial.write(b'\x04') # soft reset - the reply is the first thing printed in the REPL area
+            self.writer.start()
+
+            while self.isRunning:
+                if not self.readable():
+                    continue
+                # waits here while run() or a file transfer talks to the device
+                with self.u_serial.lock:
+                    incoming_message = self.read_available()
+                    if not incoming_message and self.readable(0):
+                        # readable without waiting bytes means a hang up, the read raises
+                        incoming_message = self.decode(self.u_serial.read(1))
+                if incoming_message:
+                    # Tk is not thread safe, the REPL shows the text on the Tk thread
+                    self.repl.receive_queue.put(incoming_message)
+                    session_log = self.repl.session_log
+                    if session_log:
+                        session_log.info(incoming_message)
+        except Exception:
+            if self.isRunning:
+                logging.exception("Serial thread failed")
+                self.stop(wait=False)
+                self.repl.receive_queue.put(None)  # the REPL disconnects on the Tk thread
+        finally:
+            with self.wake_lock:
+                os.close(self.wake_read)
+                os.close(self.wake_write)
+                self.wake_read = self.wake_write = None
+
+        logging.info("Received %d bytes, %.0f bytes/s, read path capacity %.0f bytes/s",
+                     self.bytes_received, *self.throughput())
+
+    def _write_loop(self):
+        while True:
+            message = self.repl.send_queue.get()
+            if message is None or not self.isRunning:
+                break
             try:
-                incoming_bytes = []
-                if not self.repl.send_queue.empty():
-                    message = self.repl.send_queue.get()
-                    self.u_serial.write(message)
-                if self.u_serial.inWaiting():
-                    while self.u_serial.inWaiting():
-                        incoming_bytes.append(self.u_serial.read(1))
-                    for index, byte in enumerate(incoming_bytes):
-                        if ord(byte) < 128:
-                            incoming_bytes[index] = byte.decode()
-                        else:
-                            incoming_bytes[index] = "$"
-
-                    incoming_message = "".join(incoming_bytes).replace("\r", "")
-                    self.repl.repl_text_field.insert(tk.END, incoming_message)
-                    self.repl.repl_text_field.mark_set(tk.INSERT, tk.END)
-                    self.repl.repl_text_field.see(tk.END)
-                    # if self.text_color == "grey":
-                    #     self.repl.repl_text_field.tag_add("grey", self.repl.repl_stop, tk.END)
-                    #     self.repl.repl_text_field.tag_config("grey", foreground="grey")
-                    self.repl.repl_stop = self.repl.repl_text_field.index("end-1c")
-                else:
-                    sleep(.01)
-            except Exception as e:
-                print("Serial Thread Exception !!!")
-                self.isRunning = False
-                self.repl.disconnect(False)
-
-
-        return
+                with self.u_serial.lock:
+                    with metrics.timer("serial_write"):
+                        self.u_serial.write(message)
+            except (serial.SerialException, OSError):
+                # the reader sees the port fail as well and disconnects the REPL
+                logging.exception("Serial write failed")
+                break
 
 class StatusBar(tk.Frame):
     def __init__(self, master):
         super().__init__(master)
+        self.columnconfigure(0, weight=1)
         self.label = tk.Label(self)
-        self.label.grid()
+        self.label.grid(row=0, column=0, sticky="w")
+        # live timings of the hot paths, a click writes the histograms to METRICS_FILE
+        self.metrics_label = tk.Label(self, fg="grey", cursor="hand2")
+        self.metrics_label.grid(row=0, column=1, sticky="e")
+        self.metrics_label.bind("<Button-1>", self.dump_metrics)
+        self.message_until = 0  # the live metrics are not shown before this time
         self.change_status()
+        self.after(METRICS_REFRESH, self.update_metrics)  # the startup time is shown until then
+
+    def update_metrics(self):
+        if time() >= self.message_until:
+            self.metrics_label.config(text=metrics.summary())
+        self.after(METRICS_REFRESH, self.update_metrics)
+
+    def dump_metrics(self, event=None):
+        try:
+            metrics.dump(METRICS_FILE)
+        except OSError as e:
+            message = "Metrics not written: {}".format(e)
+            logging.warning(message)
+        else:
+            message = "Metrics written to {}".format(METRICS_FILE)
+            logging.info(message)
+        self.metrics_label.config(text=message)
+        self.message_until = time() + METRICS_MESSAGE_TIME
 
-    def change_status(self, new_device=None):
+    def change_status(self, new_device=None, lost=False):
         self.device_name = new_device
         if self.device_name is None:
             self.label.config(text="Not connected. Try the 'Connect' button in the toolbar.")
+        elif lost:
+            self.label.config(text="{} was unplugged. Plug it in again to reconnect.".format(self.device_name))
         else:
             self.label.config(text="Connected to: {}".format(self.device_name))
 
@@ -642,20 +1779,24 @@ class Application(tk.Frame):
 
         self.tool_bar = Toolbar(self)
         self.tool_bar.grid(row=0, sticky="w")
-    
+        metrics.mark("toolbar")
+
         self.editor = Editor(self)
         self.editor.grid(row=1, sticky="nsew")
+        metrics.mark("editor")
 
         self.bottom_status_bar = StatusBar(self)
         self.bottom_status_bar.grid(row=2, sticky="ew")
 
         # Bind Tool Bar buttons with functions from self.editor
         self.tool_bar.buttons["run"].config(command=self.editor.run_tab)
+        self.tool_bar.buttons["broadcast"].config(command=self.editor.broadcast)
         self.tool_bar.buttons["new"].config(command=self.editor.new_tab)
         self.tool_bar.buttons["repl"].config(command=self.editor.toggle_repl)
         self.tool_bar.buttons["load_file"].config(command=self.editor.load_file)
         self.tool_bar.buttons["save_file"].config(command=self.editor.save_file)
         self.tool_bar.buttons["device"].config(command=self.editor.setup_device)
+        self.tool_bar.buttons["files"].config(command=self.editor.toggle_files)
 
     def update_title(self, device=None):
         if device:
@@ -663,15 +1804,25 @@ class Application(tk.Frame):
         else:
             self.root.title(self.title)
 
+    def started(self):
+        # called once the main loop shows the first window
+        metrics.mark("window")
+        logging.info(metrics.startup_summary())
+        self.bottom_status_bar.metrics_label.config(text=metrics.startup_summary())
+
     def close_event(self):
-        if self.editor.repl:
-            self.editor.repl.disconnect()
+        self.editor.save_session()
+        for session in list(self.editor.sessions.values()):
+            session.repl.disconnect()
         self.root.destroy()
 
 
 def run():
+    metrics.mark("imports", start=STARTUP_TIME)
     root = tk.Tk()
+    metrics.mark("tk")
     app = Application(root)
+    root.after_idle(app.started)
     app.mainloop()
 
 if __name__ == "__main__":
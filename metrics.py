@@ -0,0 +1,133 @@
+# Timings of the hot paths, byte counters and queue depths of the editor
+# and the serial connection
+import collections
+import contextlib
+import functools
+import json
+import threading
+from time import perf_counter, time
+
+METRICS_WINDOW = 1000  # last timings kept per instrumented code path
+
+
+class Metrics:
+    # Timings of the hot paths, byte counters and queue depths. Recording
+    # is a deque append, so it is cheap enough to stay on all the time.
+    HISTOGRAM_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.timings = {}  # name: deque with the last durations in seconds
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()  # counters are updated from several threads
+        self.start_time = time()
+        self.summary_time = self.start_time
+        self.summary_counters = {}
+        self.startup = []  # (phase, seconds) from the start of the imports to the first window
+        self.last_mark = perf_counter()
+
+    def record(self, name, seconds):
+        samples = self.timings.get(name)
+        if samples is None:
+            samples = self.timings.setdefault(name, collections.deque(maxlen=self.window))
+        samples.append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def timed(self, name):
+        # decorator version of timer
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def mark(self, phase, start=None):
+        # Ends a startup phase, it started at the previous mark unless start is given
+        now = perf_counter()
+        self.startup.append((phase, now - (self.last_mark if start is None else start)))
+        self.last_mark = now
+
+    def startup_summary(self):
+        total = sum(seconds for phase, seconds in self.startup)
+        return "Started in {:.0f} ms ({})".format(total * 1000, ", ".join(
+            "{} {:.0f}".format(phase, seconds * 1000) for phase, seconds in self.startup))
+
+    def summary(self):
+        # One line for the status bar: median timings, byte rates since the last call and queue depths
+        parts = []
+        for name, label in (("lexer", "lex"), ("highlight", "colour"), ("gutter", "gutter"), ("repl_insert", "repl")):
+            samples = self.timings.get(name)
+            if samples:
+                parts.append("{} {:.1f} ms".format(label, sorted(samples)[len(samples) // 2] * 1000))
+        now = time()
+        elapsed = now - self.summary_time
+        with self.lock:
+            counters = dict(self.counters)
+        if elapsed > 0:
+            for name, label in (("bytes_in", "rx"), ("bytes_out", "tx")):
+                rate = (counters.get(name, 0) - self.summary_counters.get(name, 0)) / elapsed
+                parts.append("{} {:.1f} kB/s".format(label, rate / 1000))
+        self.summary_time, self.summary_counters = now, counters
+        if "send_queue" in self.gauges:
+            parts.append("queue {}/{}".format(self.gauges["send_queue"], self.gauges.get("receive_queue", 0)))
+        return "  ".join(parts)
+
+    def histograms(self):
+        report = {}
+        for name, samples in list(self.timings.items()):
+            samples = sorted(samples)
+            if not samples:
+                continue
+            buckets = collections.OrderedDict(("<={}".format(edge), 0) for edge in self.HISTOGRAM_MS)
+            overflow = ">{}".format(self.HISTOGRAM_MS[-1])
+            buckets[overflow] = 0
+            for seconds in samples:
+                for edge in self.HISTOGRAM_MS:
+                    if seconds * 1000 <= edge:
+                        buckets["<={}".format(edge)] += 1
+                        break
+                else:
+                    buckets[overflow] += 1
+            report[name] = {
+                "samples": len(samples),
+                "median_ms": samples[len(samples) // 2] * 1000,
+                "p95_ms": samples[min(len(samples) - 1, int(len(samples) * .95))] * 1000,
+                "max_ms": samples[-1] * 1000,
+                "buckets_ms": buckets,
+            }
+        return report
+
+    def dump(self, path):
+        with self.lock:
+            counters = dict(self.counters)
+        with open(path, "w") as f:
+            json.dump({
+                "uptime": time() - self.start_time,
+                "startup_ms": collections.OrderedDict((phase, seconds * 1000) for phase, seconds in self.startup),
+                "counters": counters,
+                "gauges": dict(self.gauges),
+                "timings": self.histograms(),
+            }, f, indent=2)
+
+
+metrics = Metrics()
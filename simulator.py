@@ -0,0 +1,562 @@
+# A MicroPython board simulated on a Linux pseudo terminal.
+#
+# It speaks the friendly REPL, the raw REPL (ctrl-A/B/C/D) and the raw-paste
+# protocol and runs the received code with CPython in a separate namespace
+# whose filesystem is a directory on the host. The link speed, the size of
+# the device's UART receive buffer and the reply latency can be configured to
+# emulate slow boards. uSerial accepts the pty path like any serial port:
+#
+#     python simulator.py --baudrate 115200 --uart-buffer 256
+#     python editor.py  # and connect to the printed /dev/pts/N
+import argparse
+import binascii
+import builtins
+import codeop
+import ctypes
+import hashlib
+import io
+import os
+import posixpath
+import pty
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import tty
+import types
+import zlib
+
+BANNER = b"MicroPython v1.22.0 on 2024-01-01; simulator with CPython\r\nType \"help()\" for more information.\r\n"
+RAW_BANNER = b"raw REPL; CTRL-B to exit\r\n"
+REAL_MODULES = ("math", "cmath", "json", "struct", "random", "re", "collections", "array", "errno")
+
+
+class DeviceReset(Exception):
+    # raised by machine.reset() inside the simulated program
+    pass
+
+
+class DeviceOutput:
+    # stdout of the simulated program
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def write(self, text):
+        self.simulator.write(text.replace("\n", "\r\n").encode())
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class DeviceSimulator:
+    def __init__(self, root=None, baudrate=115200, uart_buffer=256, latency=0.0, reset_time=0.0,
+                 raw_paste=True, inflate="deflate"):
+        self.root = os.path.abspath(root or tempfile.mkdtemp(prefix="micropython_"))
+        self.baudrate = baudrate  # 0 for an unlimited link
+        self.uart_buffer = uart_buffer  # bytes the device buffers, more are dropped
+        self.latency = latency  # seconds before every reply
+        self.reset_time = reset_time  # seconds a soft reset takes
+        self.raw_paste = raw_paste  # False emulates firmware older than v1.13
+        self.inflate = inflate  # "deflate", "zlib" or None, the decompression module of the firmware
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.received = bytearray()  # the UART receive buffer
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.running = False
+        self.executing = False
+        self.interpreter = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped = 0
+
+        self.stdout = DeviceOutput(self)
+        self.soft_reset(run_main=False)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        self.receiver = threading.Thread(target=self._receive, name="SimulatorUART", daemon=True)
+        self.receiver.start()
+        self.interpreter = threading.Thread(target=self._repl, name="SimulatorREPL", daemon=True)
+        self.interpreter.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # Link
+
+    def _pace(self, size):
+        if self.baudrate:
+            time.sleep(size * 10 / self.baudrate)  # 8N1: 10 bits per byte
+
+    def _receive(self):
+        # Moves bytes from the pty into the receive buffer at the link speed.
+        # ctrl-C interrupts a running program like the UART interrupt does.
+        while self.running:
+            try:
+                data = os.read(self.master, 64)
+            except OSError:
+                break
+            self._pace(len(data))
+            with self.condition:
+                self.bytes_in += len(data)
+                if self.executing and b"\x03" in data:
+                    data = data.replace(b"\x03", b"")
+                    self._interrupt()
+                space = self.uart_buffer - len(self.received)
+                self.dropped += max(0, len(data) - space)
+                self.received += data[:space]
+                self.condition.notify_all()
+
+    def _interrupt(self):
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.interpreter.ident),
+                                                   ctypes.py_object(KeyboardInterrupt))
+
+    def read(self):
+        with self.condition:
+            while not self.received:
+                if not self.running:
+                    raise EOFError
+                self.condition.wait(.1)
+            char = bytes(self.received[:1])
+            del self.received[:1]
+            return char
+
+    def write(self, data, reply=False):
+        if reply and self.latency:
+            time.sleep(self.latency)
+        with self.write_lock:
+            for i in range(0, len(data), 64):
+                self._pace(len(data[i:i + 64]))
+                try:
+                    os.write(self.master, data[i:i + 64])
+                except OSError:
+                    return
+            self.bytes_out += len(data)
+
+    # REPL
+
+    def _repl(self):
+        self.write(b"\r\n" + BANNER + b">>> ")
+        while self.running:
+            try:
+                if self.raw:
+                    self._raw_repl_char(self.read())
+                else:
+                    self._friendly_repl_char(self.read())
+            except KeyboardInterrupt:
+                pass  # a ctrl-C that arrived just as a program ended
+            except EOFError:
+                break
+
+    def _friendly_repl_char(self, char):
+        if char == b"\x01":  # ctrl-A
+            self.raw = True
+            self.line = b""
+            self.write(b"\r\n" + RAW_BANNER + b">", reply=True)
+        elif char == b"\x03":  # ctrl-C
+            self.line = b""
+            self.source = ""
+            self.write(b"\r\n>>> ", reply=True)
+        elif char == b"\x04":  # ctrl-D
+            if not self.line and not self.source:
+                self.write(b"MPY: soft reboot\r\n", reply=True)
+                self.soft_reset(run_main=True)
+                self.write(BANNER + b">>> ")
+        elif char in (b"\x08", b"\x7f"):  # backspace
+            if self.line:
+                self.line = self.line[:-1]
+                self.write(b"\x08 \x08")
+        elif char == b"\r":
+            self.write(b"\r\n")
+            self._friendly_line(self.line.decode(errors="replace"))
+            self.line = b""
+        elif char >= b" " or char == b"\t":
+            self.line += char
+            self.write(char)
+
+    def _friendly_line(self, line):
+        self.source += line + "\n"
+        try:
+            complete = codeop.compile_command(self.source, "<stdin>", "single")
+        except (SyntaxError, OverflowError, ValueError):
+            complete = True
+        if complete is None and (line.strip() or self.source.count("\n") == 1):
+            self.write(b"... ", reply=True)
+            return
+        source, self.source = self.source, ""
+        if source.strip():
+            self.execute(source, show_result=True)
+        self.write(b">>> ", reply=True)
+
+    def _raw_repl_char(self, char):
+        if char == b"\x01":  # ctrl-A, raw-paste request after ctrl-E A
+            if self.line == b"\x05A" and self.raw_paste:
+                self.line = b""
+                self._raw_paste()
+                return
+            self.line = b""
+            self.write(RAW_BANNER + b">", reply=True)
+        elif char == b"\x02":  # ctrl-B
+            self.raw = False
+            self.line = b""
+            self.write(b"\r\n" + BANNER + b">>> ", reply=True)
+        elif char == b"\x03":  # ctrl-C
+            self.line = b""
+        elif char == b"\x04":  # ctrl-D
+            if not self.line:
+                self.write(b"soft reboot\r\n", reply=True)
+                self.soft_reset(run_main=False)
+                self.write(RAW_BANNER + b">")
+                return
+            source, self.line = self.line, b""
+            self.write(b"OK", reply=True)
+            self._raw_execute(source)
+        else:
+            self.line += char
+
+    def _raw_paste(self):
+        # Flow control: the host may send window bytes, every ctrl-A allows another window
+        window = max(2, min(self.uart_buffer, 0xffff))
+        self.write(b"R\x01" + window.to_bytes(2, "little"), reply=True)
+        source = bytearray()
+        consumed = 0
+        while True:
+            char = self.read()
+            if char == b"\x04":
+                break
+            source += char
+            consumed += 1
+            if consumed == window:
+                consumed = 0
+                self.write(b"\x01")
+        self.write(b"\x04")
+        self._raw_execute(bytes(source))
+
+    def _raw_execute(self, source):
+        error = self.execute(source.decode(errors="replace"))
+        self.write(b"\x04" + error.replace("\n", "\r\n").encode() + b"\x04>")
+
+    # Interpreter
+
+    def soft_reset(self, run_main):
+        if self.reset_time:
+            time.sleep(self.reset_time)
+        self.raw = getattr(self, "raw", False)
+        self.line = b""
+        self.source = ""
+        self.cwd = "/"
+        self.namespace = {"__name__": "__main__", "__builtins__": self._builtins()}
+        for script in ("boot.py", "main.py") if run_main else ("boot.py",):
+            path = self.path(script)
+            if os.path.isfile(path):
+                with open(path) as f:
+                    error = self.execute(f.read(), filename=script)
+                self.write(error.replace("\n", "\r\n").encode())
+
+    def execute(self, source, filename="<stdin>", show_result=False):
+        # Runs source in the device namespace, returns the traceback text or ""
+        self.executing = True
+        try:
+            try:
+                code = compile(source, filename, "eval")
+            except SyntaxError:
+                code = compile(source, filename, "exec")
+                show_result = False
+            result = eval(code, self.namespace)
+            if show_result and result is not None:
+                self.stdout.write(repr(result) + "\n")
+            return ""
+        except DeviceReset:
+            self.soft_reset(run_main=False)
+            return ""
+        except BaseException as e:
+            # hide the simulator's own frames, as if the shims were built in
+            frames = [frame for frame in traceback.extract_tb(e.__traceback__) if frame.filename != __file__]
+            return "".join(["Traceback (most recent call last):\n"] + traceback.format_list(frames) +
+                           traceback.format_exception_only(type(e), e))
+        finally:
+            self.executing = False
+            # a ctrl-C arriving just after the program ended must not hit the REPL
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(threading.get_ident()), None)
+
+    def path(self, path):
+        # Host path of a device path, the device cannot leave its root directory
+        path = posixpath.normpath(posixpath.join(self.cwd, path))
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def _builtins(self):
+        modules = self._modules()
+        loaded = modules["sys"].modules = {}  # modules imported from the device filesystem
+
+        def _import(name, globals=None, locals=None, fromlist=(), level=0):
+            if name in modules:
+                return modules[name]
+            if name in loaded:
+                return loaded[name]
+            if name in REAL_MODULES:
+                return builtins.__import__(name, globals, locals, fromlist, level)
+            for directory in modules["sys"].path:
+                path = self.path(posixpath.join(directory, name + ".py"))
+                if os.path.isfile(path):
+                    return _load(name, path, posixpath.join(directory, name + ".py"))
+            raise ImportError("no module named '{}'".format(name))
+
+        def _load(name, path, filename):
+            module = loaded[name] = types.ModuleType(name)
+            module.__file__ = filename
+            module.__builtins__ = device_builtins
+            try:
+                with builtins.open(path) as f:
+                    builtins.exec(compile(f.read(), filename, "exec"), vars(module))
+            except BaseException:
+                del loaded[name]
+                raise
+            return module
+
+        def _print(*args, **kwargs):
+            kwargs.setdefault("file", self.stdout)
+            builtins.print(*args, **kwargs)
+
+        def _input(prompt=""):
+            self.stdout.write(prompt)
+            line = b""
+            while True:
+                char = self.read()
+                if char == b"\r":
+                    self.write(b"\r\n")
+                    return line.decode(errors="replace")
+                line += char
+                self.write(char)
+
+        def _open(path, mode="r", *args, **kwargs):
+            return builtins.open(self.path(path), mode, *args, **kwargs)
+
+        def _compiled(function, mode):
+            # CPython flags the whole process as interrupted when ctrl-C stops
+            # exec or eval of a string, so the program is compiled first
+            def wrapper(source, globals=None, locals=None):
+                if isinstance(source, (str, bytes)):
+                    source = compile(source, "<string>", mode)
+                if globals is None:
+                    caller = sys._getframe(1)
+                    globals, locals = caller.f_globals, caller.f_locals if locals is None else locals
+                return function(source, globals, globals if locals is None else locals)
+            return wrapper
+
+        device_builtins = dict(vars(builtins))
+        device_builtins.update(__import__=_import, print=_print, input=_input, open=_open,
+                               exec=_compiled(builtins.exec, "exec"), eval=_compiled(builtins.eval, "eval"))
+        return device_builtins
+
+    def _modules(self):
+        simulator = self
+
+        def sleep(seconds):
+            # short steps, so that ctrl-C interrupts a sleeping program quickly
+            end = time.time() + seconds
+            while time.time() < end:
+                time.sleep(min(.01, max(0, end - time.time())))
+
+        device_time = types.ModuleType("time")
+        device_time.sleep = sleep
+        device_time.sleep_ms = lambda ms: sleep(ms / 1000)
+        device_time.sleep_us = lambda us: sleep(us / 1000000)
+        device_time.time = lambda: int(time.time())
+        device_time.ticks_ms = lambda: int(time.monotonic() * 1000) & 0x3fffffff
+        device_time.ticks_us = lambda: int(time.monotonic() * 1000000) & 0x3fffffff
+        device_time.ticks_diff = lambda a, b: ((a - b + 0x20000000) & 0x3fffffff) - 0x20000000
+
+        device_os = types.ModuleType("os")
+        device_os.listdir = lambda path=".": sorted(os.listdir(simulator.path(path)))
+        device_os.ilistdir = lambda path=".": iter([
+            (name, 0x4000 if os.path.isdir(os.path.join(simulator.path(path), name)) else 0x8000, 0,
+             os.path.getsize(os.path.join(simulator.path(path), name)))
+            for name in sorted(os.listdir(simulator.path(path)))])
+        device_os.stat = lambda path: tuple(os.stat(simulator.path(path)))[:10]
+        device_os.mkdir = lambda path: os.mkdir(simulator.path(path))
+        device_os.rmdir = lambda path: os.rmdir(simulator.path(path))
+        device_os.remove = lambda path: os.remove(simulator.path(path))
+        device_os.rename = lambda old, new: os.rename(simulator.path(old), simulator.path(new))
+        device_os.getcwd = lambda: simulator.cwd
+        device_os.uname = lambda: ("simulator", "simulator", "1.22.0", "v1.22.0", "simulator")
+
+        def chdir(path):
+            path = posixpath.normpath(posixpath.join(simulator.cwd, path))
+            if not os.path.isdir(simulator.path(path)):
+                raise OSError(2, "ENOENT")
+            simulator.cwd = path
+
+        device_os.chdir = chdir
+
+        device_sys = types.ModuleType("sys")
+        device_sys.stdout = self.stdout
+        device_sys.platform = "simulator"
+        device_sys.path = ["", "/lib"]  # "" is the current directory
+        device_sys.implementation = types.SimpleNamespace(name="micropython", version=(1, 22, 0))
+
+        def exit(code=0):
+            raise SystemExit(code)
+
+        device_sys.exit = exit
+        device_sys.print_exception = lambda e, file=None: (file or self.stdout).write(
+            "".join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+        class Pin:
+            IN, OUT, PULL_UP = 0, 1, 2
+
+            def __init__(self, pin, mode=-1, pull=-1, value=0):
+                self.pin = pin
+                self._value = value
+
+            def value(self, value=None):
+                if value is None:
+                    return self._value
+                self._value = 1 if value else 0
+
+            def on(self):
+                self._value = 1
+
+            def off(self):
+                self._value = 0
+
+        def reset():
+            raise DeviceReset
+
+        machine = types.ModuleType("machine")
+        machine.Pin = Pin
+        machine.reset = reset
+        machine.soft_reset = reset
+        machine.freq = lambda freq=None: 80000000
+        machine.unique_id = lambda: b"\x00\x01\x02\x03"
+        machine.idle = lambda: None
+
+        class NeoPixel:
+            def __init__(self, pin, n, bpp=3):
+                self.pin = pin
+                self.n = n
+                self.pixels = [(0,) * bpp] * n
+
+            def __setitem__(self, index, value):
+                self.pixels[index] = value
+
+            def __getitem__(self, index):
+                return self.pixels[index]
+
+            def __len__(self):
+                return self.n
+
+            def fill(self, value):
+                self.pixels = [value] * self.n
+
+            def write(self):
+                pass
+
+        neopixel = types.ModuleType("neopixel")
+        neopixel.NeoPixel = NeoPixel
+
+        gc = types.ModuleType("gc")
+        gc.collect = lambda: None
+        gc.mem_free = lambda: 40000
+        gc.mem_alloc = lambda: 10000
+
+        micropython = types.ModuleType("micropython")
+        micropython.const = lambda value: value
+        micropython.mem_info = lambda *args: None
+
+        device_io = types.ModuleType("io")
+        device_io.BytesIO = io.BytesIO
+        device_io.StringIO = io.StringIO
+
+        modules = {
+            "time": device_time, "utime": device_time,
+            "os": device_os, "uos": device_os,
+            "sys": device_sys, "usys": device_sys,
+            "io": device_io, "uio": device_io,
+            "hashlib": hashlib, "uhashlib": hashlib,
+            "binascii": binascii, "ubinascii": binascii,
+            "machine": machine, "neopixel": neopixel, "gc": gc, "micropython": micropython,
+        }
+        if self.inflate == "deflate":
+            modules["deflate"] = self._deflate_module()
+        elif self.inflate == "zlib":
+            modules["zlib"] = modules["uzlib"] = self._zlib_module()
+        return modules
+
+    def _deflate_module(self):
+        deflate = types.ModuleType("deflate")
+        deflate.AUTO, deflate.RAW, deflate.ZLIB, deflate.GZIP = 0, 1, 2, 3
+        wbits = {0: 47, 1: -15, 2: 15, 3: 31}
+        deflate.DeflateIO = lambda stream, format=0, wbits_=0: InflateStream(stream, wbits[format])
+        return deflate
+
+    def _zlib_module(self):
+        device_zlib = types.ModuleType("zlib")
+        device_zlib.decompress = lambda data, wbits=15, bufsize=0: zlib.decompress(data, wbits)
+        device_zlib.DecompIO = lambda stream, wbits=0: InflateStream(stream, wbits or -15)
+        return device_zlib
+
+
+class InflateStream:
+    # A stream of decompressed data, like deflate.DeflateIO and zlib.DecompIO
+    def __init__(self, stream, wbits):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(wbits)
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.stream.read(256)
+            if not data:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(data)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Simulated MicroPython board on a pseudo terminal")
+    parser.add_argument("--root", help="directory used as the device filesystem (default: a new temporary one)")
+    parser.add_argument("--baudrate", type=int, default=115200, help="link speed, 0 for unlimited")
+    parser.add_argument("--uart-buffer", type=int, default=256, help="receive buffer of the device in bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every reply")
+    parser.add_argument("--reset-time", type=float, default=0.0, help="seconds a soft reset takes")
+    parser.add_argument("--no-raw-paste", action="store_true", help="emulate firmware without raw-paste mode")
+    parser.add_argument("--inflate", choices=("deflate", "zlib", "none"), default="deflate",
+                        help="decompression module of the firmware")
+    args = parser.parse_args()
+
+    simulator = DeviceSimulator(args.root, args.baudrate, args.uart_buffer, args.latency, args.reset_time,
+                                not args.no_raw_paste, None if args.inflate == "none" else args.inflate)
+    with simulator:
+        print("Simulated device on {} (filesystem in {})".format(simulator.port, simulator.root))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("{} bytes received, {} sent, {} dropped".format(
+                simulator.bytes_in, simulator.bytes_out, simulator.dropped))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import deploy
+from simulator import DeviceSimulator
+
+
+@pytest.fixture
+def simulator(tmp_path):
+    # a board whose main.py leaves a global behind
+    root = tmp_path / "device"
+    root.mkdir()
+    (root / "main.py").write_text("LEFTOVER = 'from main.py'\n")
+    simulator = DeviceSimulator(root=str(root), baudrate=0)
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+def run_args(script, warm=False):
+    return argparse.Namespace(script=str(script), minify=False, detach=False, warm=warm, reload=(),
+                              modules=deploy.script_modules(str(script), False), timeout=deploy.RUN_TIMEOUT)
+
+
+def test_run_starts_clean(simulator, tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text("print('LEFTOVER' in globals())\n")
+    result = deploy.deploy(simulator.port, deploy.run_script, run_args(script))
+    assert result["ok"], result["output"]
+    assert result["output"] == "False\r\n"
+
+
+def test_run_warm_keeps_globals(simulator, tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text("import helper\nprint(helper.VALUE)\n")
+    (tmp_path / "helper.py").write_text("VALUE = 42\n")
+    result = deploy.deploy(simulator.port, deploy.run_script, run_args(script, warm=True))
+    assert result["ok"], result["output"]
+    assert result["output"] == "42\r\n"
+
+
+def test_run_failure_keeps_output(simulator, tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text("print('before')\n1/0\n")
+    result = deploy.deploy(simulator.port, deploy.run_script, run_args(script))
+    assert not result["ok"]
+    assert result["output"].startswith("before\r\n")
+    assert "ZeroDivisionError" in result["output"]
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from device import MODULE_CACHE_DIR, FileSync, ModuleCache, uSerial, uSerialError
+from simulator import DeviceSimulator
+
+
+@pytest.fixture(params=[True, False], ids=["raw-paste", "raw"])
+def board(request, tmp_path):
+    # (simulator, uSerial) of a fast board, with and without raw-paste mode
+    (tmp_path / "device").mkdir()
+    simulator = DeviceSimulator(root=str(tmp_path / "device"), baudrate=0, raw_paste=request.param)
+    simulator.start()
+    u_serial = uSerial(simulator.port)
+    yield simulator, u_serial
+    u_serial.close()
+    simulator.stop()
+
+
+def device_file(simulator, path):
+    with open(os.path.join(simulator.root, path.lstrip("/")), "rb") as f:
+        return f.read()
+
+
+def test_exec_raw(board):
+    simulator, u_serial = board
+    with u_serial.raw_repl():
+        assert u_serial.exec_raw("print(6 * 7)") == b"42\r\n"
+        with pytest.raises(uSerialError) as error:
+            u_serial.exec_raw("print('before')\n1/0")
+    assert error.value.output == b"before\r\n"
+    assert "ZeroDivisionError" in str(error.value)
+
+
+def test_run_with_modules(board):
+    simulator, u_serial = board
+    modules = {"helper": b"import util\nVALUE = util.VALUE * 2\n", "util": b"VALUE = 21\n"}
+    u_serial.run(b"import helper\nwith open('out.txt', 'w') as f:\n    f.write(str(helper.VALUE))\n",
+                 modules=modules)
+    with u_serial.raw_repl():
+        assert u_serial.exec_raw("print(open('out.txt').read())") == b"42\r\n"
+    assert device_file(simulator, MODULE_CACHE_DIR + "/util.py") == modules["util"]
+    with u_serial.raw_repl():
+        assert ModuleCache(u_serial).update(modules) == []  # nothing changed, nothing sent
+    assert u_serial.run(b"import helper\n", modules=modules) == []
+    modules["util"] = b"VALUE = 1\n"
+    assert u_serial.run(b"import helper\n", modules=modules) == [
+        MODULE_CACHE_DIR, MODULE_CACHE_DIR + "/manifest", MODULE_CACHE_DIR + "/util.py"]
+
+
+def test_sync_directory(board, tmp_path):
+    simulator, u_serial = board
+    local = tmp_path / "project"
+    (local / "lib").mkdir(parents=True)
+    (local / "main.py").write_text("import lib.a\n" * 100)
+    (local / "lib" / "a.py").write_bytes(bytes(range(256)))
+    (local / ".hidden").write_text("not sent")
+    with u_serial.raw_repl():
+        sync = FileSync(u_serial)
+        assert sync.sync_directory(str(local)) == ["main.py", "lib/a.py"]
+        assert sync.sync_directory(str(local)) == []
+        (local / "main.py").write_text("print('changed')\n")
+        assert sync.sync_directory(str(local)) == ["main.py"]
+        assert sync.download("lib/a.py") == bytes(range(256))
+    assert device_file(simulator, "main.py") == b"print('changed')\n"
+    assert not os.path.exists(os.path.join(simulator.root, ".hidden"))
+
+
+def test_run_sees_no_transfer_names(board):
+    # the code is big enough to be sent compressed, after a module upload
+    simulator, u_serial = board
+    code = b"# " + b"padding " * 200 + b"\nwith open('names.txt', 'w') as f:\n    f.write(' '.join(sorted(globals())))\n"
+    u_serial.run(code, modules={"helper": b"VALUE = 1\n" + b"# comment\n" * 100})
+    assert u_serial.last_transfer["ratio"] < 1
+    with u_serial.raw_repl():
+        assert u_serial.exec_raw("print(open('names.txt').read())") == b"__builtins__ __name__ f\r\n"
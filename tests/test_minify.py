@@ -0,0 +1,61 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from device import minify
+
+
+def run(source):
+    # the names a script defines, with its output as "printed"
+    printed = []
+    namespace = {"print": lambda *values: printed.append(" ".join(map(str, values)))}
+    exec(compile(source, "<minified>", "exec"), namespace)
+    namespace["printed"] = printed
+    return namespace
+
+
+SOURCES = [
+    "print('' 'x')\n",
+    "print('a' \"b\" '''c''')\n",
+    "x = ('a'  # first\n     'b')\nprint(x)\n",
+    "print(b'a' b'b')\n",
+    "print(f'{1}' 'x' f'{2}')\n",
+    "def f():\n    f'{print(1)}'\n    return 2\nprint(f())\n",
+    "def f():\n    b'data'\n    return 3\nprint(f())\n",
+    "'''Module docstring.'''\nfrom __future__ import annotations\nprint(1)\n",
+    "#!/usr/bin/env python\n# comment\n\"\"\"Module\n\ndocstring.\"\"\"\n\nfrom __future__ import annotations\nprint(2)\n",
+    "class A:\n    'Only a docstring.'\n\nprint(A.__name__)\n",
+    "def f():\n    \"\"\"Docstring\n    on lines.\"\"\"\n\nprint(f())\n",
+    "async def f():\n    'doc'\n    return 1\n",
+    "def f():\n    x = 1\n    'not a docstring'\n    return x\nprint(f())\n",
+    "print(1 .real, 'a'if 1 else'b')\n",
+]
+
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_round_trip(source):
+    minified = minify(source)
+    compile(minified, "<minified>", "exec")
+    assert len(minified.splitlines()) == len(source.splitlines())
+    assert run(minified)["printed"] == run(source)["printed"]
+
+
+def test_strips_docstrings_and_comments():
+    source = "'''Module.'''\nclass A:  # comment\n    'Class.'\n    def f(self):\n        '''Function.'''\n        return 1\n"
+    assert minify(source) == "\nclass A:\n 0\n def f(self):\n  0\n  return 1\n"
+
+
+def test_keeps_other_strings():
+    source = "def f():\n    return 1\n    'unreachable'\nf'{x}'\nb'bytes'\n"
+    minified = minify(source)
+    assert "'unreachable'" in minified
+    assert "f'{x}'" in minified
+    assert "b'bytes'" in minified
+
+
+def test_invalid_source_unchanged():
+    source = "def f(:\n    pass\n"
+    assert minify(source) == source